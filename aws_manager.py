@@ -1,17 +1,121 @@
+import asyncio
+import atexit
 import boto3
+import functools
+import hashlib
+import json
+import orjson
 import time
 import os
+import queue
+import random
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from operator import itemgetter
 import requests
 from requests.adapters import HTTPAdapter
+import logging
+import logging.handlers
 import botocore
+from botocore.config import Config
+from boto3.s3.transfer import TransferConfig
+
+def _configure_logging():
+    """
+    Route all records through a QueueHandler so request handlers never block on
+    stdout; a QueueListener thread does the formatting and the actual write.
+    """
+    root = logging.getLogger()
+    if any(isinstance(h, logging.handlers.QueueHandler) for h in root.handlers):
+        return
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+
+
+_configure_logging()
+log = logging.getLogger("cloudram.aws")
 
 try:
     from urllib3.util.retry import Retry
 except ImportError:
-    print("⚠️ urllib3.util.retry not found. Installing urllib3 explicitly might be required.")
+    log.warning("⚠️ urllib3.util.retry not found. Installing urllib3 explicitly might be required.")
     Retry = None
 
 
+# Shared client config: bigger keep-alive pool + adaptive retries so concurrent
+# requests reuse connections instead of re-handshaking per call.
+BOTO_CONFIG = Config(
+    max_pool_connections=50,
+    retries={"max_attempts": 10, "mode": "adaptive"},
+    tcp_keepalive=True,
+    user_agent_extra="cloudramsaas/1",
+)
+
+SCRIPT_TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 << 20, max_concurrency=8)
+
+# RAM size (GB) -> instance type. Ops can override/extend with JSON, e.g.
+# CLOUDRAM_INSTANCE_MAP='{"8": "m6i.large"}'
+_INSTANCE_TYPES = {1: "t3.micro", 2: "t3.small", 4: "t3.medium", 8: "t3.large", 16: "t3.xlarge"}
+_DEFAULT_INSTANCE_TYPE = "t3.medium"
+
+_instance_map_override = os.getenv("CLOUDRAM_INSTANCE_MAP")
+if _instance_map_override:
+    try:
+        _INSTANCE_TYPES.update({int(k): str(v) for k, v in json.loads(_instance_map_override).items()})
+    except (ValueError, AttributeError) as e:
+        log.warning(f"⚠️ Ignoring invalid CLOUDRAM_INSTANCE_MAP: {e}")
+
+# VM ingress rules (one entry per port; sorted + de-duplicated).
+# RDP is the riskiest rule to leave world-open: restrict it with CLOUDRAM_RDP_CIDR.
+_OPEN_TCP_PORTS = (80, 443, 5000, 5900, 6080, 8080)
+_RDP_CIDR = os.getenv("CLOUDRAM_RDP_CIDR", "0.0.0.0/0")
+_INGRESS_PERMS = [
+    {"IpProtocol": "tcp", "FromPort": 3389, "ToPort": 3389, "IpRanges": [{"CidrIp": _RDP_CIDR}]},
+] + [
+    {"IpProtocol": "tcp", "FromPort": port, "ToPort": port, "IpRanges": [{"CidrIp": "0.0.0.0/0"}]}
+    for port in sorted(set(_OPEN_TCP_PORTS))
+]
+
+
+def ttl_cache(seconds: float):
+    """
+    Cache a zero-arg AWSManager method's result on the instance for `seconds`.
+    Failed lookups (None, or a tuple starting with None) are never cached;
+    `Class.method.cache_clear(instance)` drops a cached value early.
+    """
+    def decorator(fn):
+        attr = f"_ttl_cache_{fn.__name__}"
+
+        @functools.wraps(fn)
+        def wrapper(self):
+            cached = getattr(self, attr, None)
+            if cached and cached[1] > time.monotonic():
+                return cached[0]
+
+            value = fn(self)
+            missed = value is None or (isinstance(value, tuple) and value and value[0] is None)
+            if missed:
+                setattr(self, attr, None)
+            else:
+                setattr(self, attr, (value, time.monotonic() + seconds))
+            return value
+
+        def cache_clear(self):
+            self.__dict__.pop(attr, None)
+
+        wrapper.cache_clear = cache_clear
+        return wrapper
+
+    return decorator
+
+
 class AWSManager:
     """
     CloudRAMSaaS AWS manager.
@@ -27,35 +131,53 @@ class AWSManager:
     APP_TAG_VALUE = "CloudRAMSaaS"
 
     def __init__(self):
-        """Initialize AWS EC2 client and resource manager."""
-        self.ec2 = boto3.client("ec2")
-        self.ec2_resource = boto3.resource("ec2")
-        self.s3 = boto3.client("s3")
+        """Initialize AWS EC2 client and resource manager from one shared session."""
+        self._session = boto3.session.Session()
+        self.ec2 = self._session.client("ec2", config=BOTO_CONFIG)
+        self.ec2_resource = self._session.resource("ec2", config=BOTO_CONFIG)
+        self.s3 = self._session.client("s3", config=BOTO_CONFIG)
         self.bucket_name = os.getenv("CLOUDRAM_SCRIPTS_BUCKET", "cloud-ram-scripts")
+        self._user_data = None
+        self._uploaded_sha = None
+
+        # Keep-alive session for VM agent calls (one pool shared by all VM IPs).
+        self._http = requests.Session()
+        retries = Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504]) if Retry else 0
+        self._http.mount("http://", HTTPAdapter(pool_connections=64, pool_maxsize=64, max_retries=retries))
+
+        # /install_app is slow and worth retrying harder; keep its own pooled session
+        # instead of building a fresh one (and a fresh TCP connection) per install.
+        self._install_http = requests.Session()
+        install_retries = Retry(total=3, backoff_factor=2, status_forcelist=[500, 502, 503, 504]) if Retry else 0
+        self._install_http.mount("http://", HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=install_retries))
 
     # -------------------------
     # Key Pair / SG / AMI
     # -------------------------
+    @ttl_cache(seconds=3600)
     def create_key_pair(self):
         key_name = "cloud-ram-key"
 
         try:
             self.ec2.describe_key_pairs(KeyNames=[key_name])
-            print(f"✅ Key Pair {key_name} exists in AWS.")
+            log.info(f"✅ Key Pair {key_name} exists in AWS.")
             return key_name, None
         except botocore.exceptions.ClientError as e:
-            print("❌ Key pair not found in AWS:", e)
+            log.error(f"❌ Key pair not found in AWS: {e}")
             return None, None
 
+    @ttl_cache(seconds=3600)
     def create_security_group(self):
         """Dynamically creates a security group for the VM."""
         sg_name = os.getenv("CLOUDRAM_SG_NAME", "cloud-ram-sg")
         try:
-            existing_sgs = self.ec2.describe_security_groups()["SecurityGroups"]
-            for sg in existing_sgs:
-                if sg["GroupName"] == sg_name:
-                    print(f"✅ Security Group {sg_name} already exists.")
-                    return sg["GroupId"]
+            # Server-side name filter: EC2 returns 0 or 1 rows (and no NotFound error outside the default VPC).
+            existing_sgs = self.ec2.describe_security_groups(
+                Filters=[{"Name": "group-name", "Values": [sg_name]}]
+            )["SecurityGroups"]
+            if existing_sgs:
+                log.info(f"✅ Security Group {sg_name} already exists.")
+                return existing_sgs[0]["GroupId"]
 
             response = self.ec2.create_security_group(
                 GroupName=sg_name,
@@ -65,59 +187,87 @@ class AWSManager:
 
             self.ec2.authorize_security_group_ingress(
                 GroupId=sg_id,
-                IpPermissions=[
-                    {"IpProtocol": "tcp", "FromPort": 3389, "ToPort": 3389, "IpRanges": [{"CidrIp": "0.0.0.0/0"}]},
-                    {"IpProtocol": "tcp", "FromPort": 5000, "ToPort": 5000, "IpRanges": [{"CidrIp": "0.0.0.0/0"}]},
-                    {"IpProtocol": "tcp", "FromPort": 80, "ToPort": 80, "IpRanges": [{"CidrIp": "0.0.0.0/0"}]},
-                    {"IpProtocol": "tcp", "FromPort": 443, "ToPort": 443, "IpRanges": [{"CidrIp": "0.0.0.0/0"}]},
-                    {"IpProtocol": "tcp", "FromPort": 8080, "ToPort": 8080, "IpRanges": [{"CidrIp": "0.0.0.0/0"}]},
-                    {"IpProtocol": "tcp", "FromPort": 5900, "ToPort": 5900, "IpRanges": [{"CidrIp": "0.0.0.0/0"}]},
-                    {"IpProtocol": "tcp", "FromPort": 6080, "ToPort": 6080, "IpRanges": [{"CidrIp": "0.0.0.0/0"}]},
-                ]
+                IpPermissions=_INGRESS_PERMS,
             )
-            print(f"🛡 New Security Group Created: {sg_name} ({sg_id})")
+            log.info(f"🛡 New Security Group Created: {sg_name} ({sg_id})")
             return sg_id
         except Exception as e:
-            print(f"❌ Error creating security group: {str(e)}")
+            log.error(f"❌ Error creating security group: {str(e)}")
             return None
 
+    @ttl_cache(seconds=3600)
     def get_latest_windows_ami(self):
         """Finds the latest Windows Server AMI dynamically."""
         try:
-            response = self.ec2.describe_images(
+            pages = self.ec2.get_paginator("describe_images").paginate(
                 Filters=[
                     {"Name": "platform", "Values": ["windows"]},
-                    {"Name": "name", "Values": ["Windows_Server-2022-English-Full-Base*"]}
+                    {"Name": "name", "Values": ["Windows_Server-2022-English-Full-Base*"]},
+                    {"Name": "state", "Values": ["available"]},
                 ],
-                Owners=["amazon"]
+                Owners=["amazon"],
+                IncludeDeprecated=False,
+                PaginationConfig={"PageSize": 100},
             )
-            if not response["Images"]:
-                print("❌ No Windows Server AMI found.")
+            # Track the newest image while streaming pages instead of materializing + sorting.
+            newest = None
+            for page in pages:
+                for image in page.get("Images", []):
+                    if newest is None or image["CreationDate"] > newest["CreationDate"]:
+                        newest = image
+            if newest is None:
+                log.error("❌ No Windows Server AMI found.")
                 return None
-            ami_id = sorted(response["Images"], key=lambda x: x["CreationDate"], reverse=True)[0]["ImageId"]
-            print(f"📦 Latest Windows AMI Found: {ami_id}")
+            ami_id = newest["ImageId"]
+            log.info(f"📦 Latest Windows AMI Found: {ami_id}")
             return ami_id
         except Exception as e:
-            print(f"❌ Error fetching Windows AMI: {str(e)}")
+            log.error(f"❌ Error fetching Windows AMI: {str(e)}")
             return None
 
     # -------------------------
     # S3 VM script upload
     # -------------------------
     def upload_script_to_s3(self):
+        """
+        Upload vm_server.py unless S3 already holds the same content.
+        The blake2s digest is stored as object metadata ("sha") and remembered per process.
+        """
         script_path = os.path.join("vm_scripts", "vm_server.py")
         script_key = "vm_server.py"
 
         if not os.path.exists(script_path):
-            print(f"❌ Flask Server script not found at {script_path}")
+            log.error(f"❌ Flask Server script not found at {script_path}")
             return None
 
         try:
-            self.s3.upload_file(script_path, self.bucket_name, script_key)
-            print(f"📤 Uploaded {script_path} to s3://{self.bucket_name}/{script_key}")
+            with open(script_path, "rb") as f:
+                digest = hashlib.blake2s(f.read()).hexdigest()
+
+            if self._uploaded_sha == digest:
+                return True
+
+            try:
+                head = self.s3.head_object(Bucket=self.bucket_name, Key=script_key)
+                if head.get("Metadata", {}).get("sha") == digest:
+                    log.info(f"✅ s3://{self.bucket_name}/{script_key} already up to date")
+                    self._uploaded_sha = digest
+                    return True
+            except botocore.exceptions.ClientError:
+                pass  # missing object (or no HEAD permission): just upload
+
+            self.s3.upload_file(
+                script_path,
+                self.bucket_name,
+                script_key,
+                ExtraArgs={"Metadata": {"sha": digest}},
+                Config=SCRIPT_TRANSFER_CONFIG,
+            )
+            self._uploaded_sha = digest
+            log.info(f"📤 Uploaded {script_path} to s3://{self.bucket_name}/{script_key}")
             return True
         except Exception as e:
-            print(f"❌ Error uploading script to S3: {str(e)}")
+            log.error(f"❌ Error uploading script to S3: {str(e)}")
             return None
 
     # -------------------------
@@ -130,26 +280,44 @@ class AWSManager:
         """
         if not user_id:
             return None
+        return (self.find_user_instances([user_id]) or {}).get(user_id)
+
+    def find_user_instances(self, user_ids):
+        """
+        Batched variant of find_user_instance: one DescribeInstances for many users.
+        Returns {user_id: newest instance}; users without an instance are omitted.
+        Returns None if the lookup itself failed.
+        """
+        user_ids = [u for u in user_ids if u]
+        if not user_ids:
+            return {}
 
         try:
-            resp = self.ec2.describe_instances(
+            pages = self.ec2.get_paginator("describe_instances").paginate(
                 Filters=[
-                    {"Name": f"tag:{self.USER_TAG_KEY}", "Values": [user_id]},
+                    {"Name": f"tag:{self.USER_TAG_KEY}", "Values": user_ids},
                     {"Name": "instance-state-name", "Values": ["pending", "running", "stopping", "stopped"]},
-                ]
+                ],
+                PaginationConfig={"PageSize": 1000},
             )
 
-            instances = []
-            for r in resp.get("Reservations", []):
-                instances.extend(r.get("Instances", []))
-
-            if not instances:
-                return None
+            instances = chain.from_iterable(
+                r.get("Instances", []) for page in pages for r in page.get("Reservations", [])
+            )
 
-            instances.sort(key=lambda x: x["LaunchTime"], reverse=True)
-            return instances[0]
+            by_owner = {}
+            for inst in instances:
+                owner = next(
+                    (t["Value"] for t in inst.get("Tags", []) if t["Key"] == self.USER_TAG_KEY),
+                    None,
+                )
+                if owner is not None:
+                    by_owner.setdefault(owner, []).append(inst)
+
+            # Newest instance per user: single O(n) max() pass, no sorted copy.
+            return {owner: max(insts, key=itemgetter("LaunchTime")) for owner, insts in by_owner.items()}
         except Exception as e:
-            print(f"❌ Error finding user instance: {str(e)}")
+            log.error(f"❌ Error finding user instances: {str(e)}")
             return None
 
     def get_instance_state_and_ip(self, vm_id: str):
@@ -160,44 +328,66 @@ class AWSManager:
             ip = inst.get("PublicIpAddress")
             return state, ip
         except Exception as e:
-            print(f"❌ Error describing instance {vm_id}: {e}")
+            log.error(f"❌ Error describing instance {vm_id}: {e}")
             return None, None
 
-    def wait_for_running_and_ip(self, vm_id: str, timeout=240):
-        start = time.time()
-        while time.time() - start < timeout:
-            state, ip = self.get_instance_state_and_ip(vm_id)
-            if state == "running" and ip:
-                return ip
-            time.sleep(3)
+    def wait_for_running_and_ip(self, vm_id: str, timeout=240, poll_interval=5):
+        """
+        Poll the lightweight DescribeInstanceStatus until the instance is running,
+        then read the public IP with a single DescribeInstances.
+        The poll starts at 1s and doubles up to poll_interval, with +/-20% jitter, so a
+        fast boot is noticed quickly and concurrent starts don't poll EC2 in lockstep.
+        """
+        deadline = time.monotonic() + timeout
+        delay = min(1.0, poll_interval)
+        while True:
+            try:
+                resp = self.ec2.describe_instance_status(InstanceIds=[vm_id], IncludeAllInstances=True)
+                statuses = resp.get("InstanceStatuses", [])
+                state = statuses[0]["InstanceState"]["Name"] if statuses else None
+            except Exception as e:
+                log.error(f"❌ Error describing instance status {vm_id}: {e}")
+                state = None
+
+            if state == "running":
+                break
+            sleep_for = delay * random.uniform(0.8, 1.2)
+            if time.monotonic() + sleep_for > deadline:
+                raise RuntimeError("Timed out waiting for instance to be running.")
+            time.sleep(sleep_for)
+            delay = min(delay * 2, poll_interval)
+
+        state, ip = self.get_instance_state_and_ip(vm_id)
+        if state == "running" and ip:
+            return ip
         raise RuntimeError("Timed out waiting for instance to be running with a public IP.")
 
     def stop_vm(self, vm_id: str):
         try:
             self.ec2.stop_instances(InstanceIds=[vm_id])
-            print(f"🟡 Stop requested for VM {vm_id}")
+            log.info(f"🟡 Stop requested for VM {vm_id}")
             return True
         except Exception as e:
-            print(f"❌ Error stopping VM {vm_id}: {e}")
+            log.error(f"❌ Error stopping VM {vm_id}: {e}")
             return False
 
     def start_vm(self, vm_id: str):
         try:
             self.ec2.start_instances(InstanceIds=[vm_id])
-            print(f"🟢 Start requested for VM {vm_id}")
+            log.info(f"🟢 Start requested for VM {vm_id}")
             return True
         except Exception as e:
-            print(f"❌ Error starting VM {vm_id}: {e}")
+            log.error(f"❌ Error starting VM {vm_id}: {e}")
             return False
 
     def terminate_vm(self, vm_id):
         """Terminates the EC2 instance."""
         try:
             self.ec2.terminate_instances(InstanceIds=[vm_id])
-            print(f"🛑 VM {vm_id} Terminated.")
+            log.info(f"🛑 VM {vm_id} Terminated.")
             return True
         except Exception as e:
-            print(f"❌ Error terminating VM: {str(e)}")
+            log.error(f"❌ Error terminating VM: {str(e)}")
             return False
 
     # -------------------------
@@ -206,55 +396,47 @@ class AWSManager:
     def wait_for_vm_services(self, ip_address: str, max_attempts=180):
         """
         Wait for Flask server on VM (port 5000) to become ready.
-        Uses retry strategy; times out after ~30 minutes (180 * 10 sec).
+        Probes on one kept-alive session with full-jitter exponential backoff (0.5s doubling, capped at 30s);
+        the overall budget stays max_attempts * 10 sec (~30 minutes by default).
         """
         session = requests.Session()
-        if Retry:
-            retry_strategy = Retry(total=10, backoff_factor=5, status_forcelist=[500, 502, 503, 504])
-            adapter = HTTPAdapter(max_retries=retry_strategy)
-            session.mount("http://", adapter)
+        session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
 
-        print(f"⏳ Waiting for Flask server at {ip_address}:5000...")
-        for attempt in range(max_attempts):
+        log.info(f"⏳ Waiting for Flask server at {ip_address}:5000...")
+        deadline = time.monotonic() + max_attempts * 10
+        attempt = 0
+        while time.monotonic() < deadline:
+            attempt += 1
             try:
-                r = session.get(f"http://{ip_address}:5000/", timeout=20)
+                r = session.get(f"http://{ip_address}:5000/", timeout=3)
                 if r.status_code == 200:
-                    print(f"✅ Flask server ready at {ip_address}:5000 after {attempt + 1} attempts")
+                    log.info(f"✅ Flask server ready at {ip_address}:5000 after {attempt} attempts")
                     return True
             except requests.RequestException as e:
-                print(f"⏳ Attempt {attempt + 1}/{max_attempts}: Waiting for Flask... ({str(e)})")
-                time.sleep(10)
+                log.info("⏳ Attempt %d: Waiting for Flask... (%s)", attempt, e)
+
+            # Full jitter keeps concurrent waiters from probing in lockstep.
+            backoff = random.uniform(0, min(30, 0.5 * 2 ** min(attempt - 1, 6)))
+            time.sleep(max(0, min(backoff, deadline - time.monotonic())))
 
-        print(f"❌ Flask server not ready after waiting at {ip_address}:5000")
+        log.error(f"❌ Flask server not ready after waiting at {ip_address}:5000")
         return False
 
     # -------------------------
     # Create VM (per user)
     # -------------------------
-    def create_vm(self, ram_size: int, user_id: str):
-        r"""
-        Create a Windows VM for user_id.
-        Uses ONE shared EC2 keypair name, and downloads the PEM from S3 inside the VM via startup script.
-
-        Env:
-        CLOUDRAM_IAM_INSTANCE_PROFILE (default: CloudRAMEC2Role)
-        CLOUDRAM_KEY_BUCKET          (default: cloud-ram-secrets)
-        CLOUDRAM_KEY_OBJECT          (default: keys/cloud-ram-key.pem)
+    def _build_user_data(self):
         """
-        # upload your vm_server.py (or other scripts) first
-        self.upload_script_to_s3()
-
-        key_name, _ = self.create_key_pair()
-        if not key_name:
-            print("❌ Failed to create or retrieve key pair.")
-            return None, None
-
-        instance_type = {1: "t3.micro", 2: "t3.small", 4: "t3.medium"}.get(ram_size, "t3.medium")
+        Startup script + PEM download, assembled once per process (the inputs don't change).
+        boto3 base64-encodes RunInstances UserData itself, so the plain string is cached.
+        """
+        if self._user_data is not None:
+            return self._user_data
 
         startup_script_path = os.path.join("vm_scripts", "vm_startup_script.ps1")
         if not os.path.exists(startup_script_path):
-            print(f"❌ Startup script not found at {startup_script_path}")
-            return None, None
+            log.error(f"❌ Startup script not found at {startup_script_path}")
+            return None
 
         with open(startup_script_path, "r", encoding="utf-8") as f:
             startup_script = f.read()
@@ -264,65 +446,100 @@ class AWSManager:
 
         # IMPORTANT: vm_startup_script.ps1 should ensure AWS CLI exists before "aws s3 cp" runs.
         # (I showed that snippet earlier—add it near the top of vm_startup_script.ps1)
-        user_data = (
+        self._user_data = (
             f"{startup_script}\n\n"
             "New-Item -ItemType Directory -Path 'C:\\CloudRAM' -Force\n"
             f"aws s3 cp s3://{key_bucket}/{key_object} C:\\CloudRAM\\cloud-ram-key.pem\n"
             "icacls 'C:\\CloudRAM\\cloud-ram-key.pem' /inheritance:r /grant:r 'Administrators:F'\n"
         )
+        return self._user_data
+
+    def create_vm(self, ram_size: int, user_id: str):
+        r"""
+        Create a Windows VM for user_id.
+        Uses ONE shared EC2 keypair name, and downloads the PEM from S3 inside the VM via startup script.
+
+        Env:
+        CLOUDRAM_IAM_INSTANCE_PROFILE (default: CloudRAMEC2Role)
+        CLOUDRAM_KEY_BUCKET          (default: cloud-ram-secrets)
+        CLOUDRAM_KEY_OBJECT          (default: keys/cloud-ram-key.pem)
+        """
+        # The script upload and key/AMI/SG lookups are independent network calls: run them together.
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            upload_fut = pool.submit(self.upload_script_to_s3)
+            key_fut = pool.submit(self.create_key_pair)
+            ami_fut = pool.submit(self.get_latest_windows_ami)
+            sg_fut = pool.submit(self.create_security_group)
+            upload_fut.result()
+            key_name, _ = key_fut.result()
+            ami = ami_fut.result()
+            sg_id = sg_fut.result()
+
+        if not key_name:
+            log.error("❌ Failed to create or retrieve key pair.")
+            return None, None
+
+        instance_type = _INSTANCE_TYPES.get(ram_size, _DEFAULT_INSTANCE_TYPE)
+
+        user_data = self._build_user_data()
+        if user_data is None:
+            return None, None
 
         try:
-            ami = self.get_latest_windows_ami()
             if not ami:
                 return None, None
 
-            sg_id = self.create_security_group()
             if not sg_id:
                 return None, None
 
             profile_name = os.getenv("CLOUDRAM_IAM_INSTANCE_PROFILE", "CloudRAMEC2Role")
 
-            print(f"🚀 Creating EC2 instance for user={user_id} with {ram_size}GB RAM ({instance_type})")
-            response = self.ec2.run_instances(
-                ImageId=ami,
-                InstanceType=instance_type,
-                MinCount=1,
-                MaxCount=1,
-                KeyName=key_name,
-                SecurityGroupIds=[sg_id],
-                UserData=user_data,
-                IamInstanceProfile={"Name": profile_name},
-                TagSpecifications=[
-                    {
-                        "ResourceType": "instance",
-                        "Tags": [
-                            {"Key": self.USER_TAG_KEY, "Value": user_id},
-                            {"Key": self.APP_TAG_KEY, "Value": self.APP_TAG_VALUE},
-                        ],
-                    }
-                ],
-            )
+            log.info(f"🚀 Creating EC2 instance for user={user_id} with {ram_size}GB RAM ({instance_type})")
+            try:
+                response = self.ec2.run_instances(
+                    ImageId=ami,
+                    InstanceType=instance_type,
+                    MinCount=1,
+                    MaxCount=1,
+                    KeyName=key_name,
+                    SecurityGroupIds=[sg_id],
+                    UserData=user_data,
+                    IamInstanceProfile={"Name": profile_name},
+                    TagSpecifications=[
+                        {
+                            "ResourceType": "instance",
+                            "Tags": [
+                                {"Key": self.USER_TAG_KEY, "Value": user_id},
+                                {"Key": self.APP_TAG_KEY, "Value": self.APP_TAG_VALUE},
+                            ],
+                        }
+                    ],
+                )
+            except botocore.exceptions.ClientError:
+                # A deleted security group / key pair or a retired AMI would otherwise keep
+                # failing every launch until the hour-long lookups expire.
+                for cached in (AWSManager.create_security_group, AWSManager.get_latest_windows_ami,
+                               AWSManager.create_key_pair):
+                    cached.cache_clear(self)
+                raise
 
             instance = response["Instances"][0]
             vm_id = instance["InstanceId"]
 
-            print("⏳ Waiting for instance to start...")
-            waiter = self.ec2.get_waiter("instance_running")
-            waiter.wait(InstanceIds=[vm_id])
-
+            log.info("⏳ Waiting for instance to start...")
             ip_address = self.wait_for_running_and_ip(vm_id)
-            print(f"✅ Instance running at {ip_address}. Waiting for services...")
+            log.info(f"✅ Instance running at {ip_address}. Waiting for services...")
 
             ok = self.wait_for_vm_services(ip_address)
             if not ok:
                 self.terminate_vm(vm_id)
                 return None, None
 
-            print(f"✅ VM Created: ID={vm_id}, IP={ip_address}")
+            log.info(f"✅ VM Created: ID={vm_id}, IP={ip_address}")
             return vm_id, ip_address
 
         except Exception as e:
-            print(f"❌ Error creating VM: {str(e)}")
+            log.error(f"❌ Error creating VM: {str(e)}")
             return None, None
 
     # -------------------------
@@ -332,81 +549,173 @@ class AWSManager:
         """Check VM's running processes and resource usage."""
         try:
             url = f"http://{vm_ip}:5000/ram_usage"
-            response = requests.get(url, timeout=10)
+            response = self._http.get(url, timeout=10)
             if response.status_code != 200:
                 return {"error": f"Failed to fetch status, status code: {response.status_code}"}
-            return response.json()
-        except requests.RequestException as e:
-            print(f"❌ Error fetching VM status: {str(e)}")
+            return orjson.loads(response.content)
+        except (requests.RequestException, orjson.JSONDecodeError) as e:
+            log.error(f"❌ Error fetching VM status: {str(e)}")
             return {"error": str(e)}
 
     def install_application_on_vm(self, vm_ip, app_name):
         """Dynamically install an application on the VM if not present."""
         try:
-            response = requests.get(f"http://{vm_ip}:5000/list_tasks", timeout=10)
+            response = self._http.get(f"http://{vm_ip}:5000/list_tasks", timeout=10)
             if response.status_code == 200:
-                tasks = response.json().get("tasks", [])
-                if any(task["name"].lower() == app_name.lower() for task in tasks):
-                    print(f"✅ {app_name} already running on VM {vm_ip}")
+                tasks = orjson.loads(response.content).get("tasks", [])
+                wanted = app_name.lower()
+                if any(task["name"].lower() == wanted for task in tasks):
+                    log.info(f"✅ {app_name} already running on VM {vm_ip}")
                     return True
 
-            session = requests.Session()
-            if Retry:
-                retry_strategy = Retry(total=3, backoff_factor=2, status_forcelist=[500, 502, 503, 504])
-                adapter = HTTPAdapter(max_retries=retry_strategy)
-                session.mount("http://", adapter)
-
             install_payload = {"app_name": app_name}
-            print(f"⏳ Attempting to install {app_name} on VM {vm_ip}")
-            response = session.post(f"http://{vm_ip}:5000/install_app", json=install_payload, timeout=120)
+            log.info(f"⏳ Attempting to install {app_name} on VM {vm_ip}")
+            response = self._install_http.post(f"http://{vm_ip}:5000/install_app", json=install_payload, timeout=120)
             if response.status_code == 200:
-                print(f"✅ Successfully installed {app_name} on VM {vm_ip}")
+                log.info(f"✅ Successfully installed {app_name} on VM {vm_ip}")
                 return True
             else:
-                print(f"❌ Failed to install {app_name}: {response.text}")
+                log.error(f"❌ Failed to install {app_name}: {response.text}")
                 return False
 
         except requests.Timeout as e:
-            print(f"❌ Timeout installing {app_name} on VM {vm_ip}: {str(e)}")
+            log.error(f"❌ Timeout installing {app_name} on VM {vm_ip}: {str(e)}")
             return False
         except requests.RequestException as e:
-            print(f"❌ Error installing {app_name} on VM {vm_ip}: {str(e)}")
+            log.error(f"❌ Error installing {app_name} on VM {vm_ip}: {str(e)}")
             return False
         except Exception as e:
-            print(f"❌ Unexpected error installing {app_name} on VM {vm_ip}: {str(e)}")
+            log.error(f"❌ Unexpected error installing {app_name} on VM {vm_ip}: {str(e)}")
             return False
 
     def migrate_task_with_ui(self, vm_ip, task_name):
         """Migrate a task and return the VNC URL for UI streaming."""
         try:
             if not self.install_application_on_vm(vm_ip, task_name):
-                print(f"❌ Failed to install {task_name} on VM {vm_ip}")
+                log.error(f"❌ Failed to install {task_name} on VM {vm_ip}")
                 return None
 
-            print(f"⏳ Migrating {task_name} with UI streaming to VM {vm_ip}")
-            response = requests.post(
+            log.info(f"⏳ Migrating {task_name} with UI streaming to VM {vm_ip}")
+            response = self._http.post(
                 f"http://{vm_ip}:5000/migrate_task_with_ui",
                 json={"task_name": task_name, "task_data": {"state": "auto_migrated"}},
                 timeout=60
             )
 
             if response.status_code == 200:
-                response_data = response.json()
+                response_data = orjson.loads(response.content)
                 stream_url = response_data.get("web_vnc_url", f"http://{vm_ip}:8080/vnc.html")
                 vnc_direct = response_data.get("vnc_url", f"vnc://{vm_ip}:5900")
 
-                print(f"✅ Task {task_name} migrated with UI streaming")
-                print(f"Web VNC: {stream_url}")
-                print(f"Direct VNC: {vnc_direct}")
+                log.info(f"✅ Task {task_name} migrated with UI streaming")
+                log.info(f"Web VNC: {stream_url}")
+                log.info(f"Direct VNC: {vnc_direct}")
 
                 return stream_url
             else:
-                print(f"❌ Failed to migrate {task_name}: {response.text}")
+                log.error(f"❌ Failed to migrate {task_name}: {response.text}")
                 return None
         except Exception as e:
-            print(f"❌ Error migrating {task_name} with UI: {str(e)}")
+            log.error(f"❌ Error migrating {task_name} with UI: {str(e)}")
+            return None
+
+
+class DescribeInstancesBatcher:
+    """
+    Coalesces concurrent find_user_instance lookups.
+
+    Callers awaiting get() within the same window share a single
+    DescribeInstances call (tag filter with all pending user ids).
+    Results are cached per user for `cache_ttl_seconds`; call invalidate()
+    after any mutation (start/stop/terminate/create) so it is never served stale.
+    """
+
+    MAX_BATCH = 200  # stay under the EC2 filter-values limit
+
+    def __init__(self, manager: AWSManager, window_seconds: float = 0.25, cache_ttl_seconds: float = 10):
+        self.manager = manager
+        self.window_seconds = window_seconds
+        self.cache_ttl_seconds = cache_ttl_seconds
+        self._pending = {}  # user_id -> [Future]
+        self._flush_task = None
+        self._cache = {}  # user_id -> (expires_at, instance or None)
+        # Only users with a DescribeInstances call in flight need an invalidation counter
+        # (to spot results raced by invalidate()); entries are dropped once none remain.
+        self._in_flight = {}  # user_id -> number of flushes currently looking it up
+        self._versions = {}  # user_id -> invalidation counter
+
+    def invalidate(self, user_id: str):
+        self._cache.pop(user_id, None)
+        if user_id in self._in_flight:
+            self._versions[user_id] = self._versions.get(user_id, 0) + 1
+
+    async def get(self, user_id: str):
+        if not user_id:
             return None
 
+        cached = self._cache.get(user_id)
+        if cached:
+            if cached[0] > time.monotonic():
+                return cached[1]
+            del self._cache[user_id]
+
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._pending.setdefault(user_id, []).append(fut)
+        if self._flush_task is None:
+            self._flush_task = loop.create_task(self._flush_after_window())
+        return await fut
+
+    async def _flush_after_window(self):
+        await asyncio.sleep(self.window_seconds)
+        pending, self._pending = self._pending, {}
+        self._flush_task = None
+
+        now = time.monotonic()
+        for user_id in [u for u, (exp, _) in self._cache.items() if exp <= now]:
+            del self._cache[user_id]
+
+        user_ids = list(pending)
+        versions = {u: self._versions.get(u, 0) for u in user_ids}
+        for user_id in user_ids:
+            self._in_flight[user_id] = self._in_flight.get(user_id, 0) + 1
+        try:
+            await self._lookup(pending, user_ids, versions)
+        finally:
+            for user_id in user_ids:
+                remaining = self._in_flight.pop(user_id) - 1
+                if remaining:
+                    self._in_flight[user_id] = remaining
+                else:
+                    self._versions.pop(user_id, None)
+
+    async def _lookup(self, pending: dict, user_ids: list, versions: dict):
+        chunks = [user_ids[i:i + self.MAX_BATCH] for i in range(0, len(user_ids), self.MAX_BATCH)]
+        results = await asyncio.gather(
+            *[asyncio.to_thread(self.manager.find_user_instances, chunk) for chunk in chunks],
+            return_exceptions=True,
+        )
+
+        expires_at = time.monotonic() + self.cache_ttl_seconds
+        for chunk, found in zip(chunks, results):
+            for user_id in chunk:
+                if isinstance(found, BaseException):
+                    outcome = found
+                else:
+                    inst = (found or {}).get(user_id)
+                    # Don't cache failed lookups, or results raced by an invalidate().
+                    if found is not None and self._versions.get(user_id, 0) == versions[user_id]:
+                        self._cache[user_id] = (expires_at, inst)
+                    outcome = inst
+
+                for fut in pending[user_id]:
+                    if fut.done():
+                        continue
+                    if isinstance(outcome, BaseException):
+                        fut.set_exception(outcome)
+                    else:
+                        fut.set_result(outcome)
+
 
 if __name__ == "__main__":
     manager = AWSManager()
@@ -3,22 +3,44 @@
 # ✅ This file keeps: Auth (Supabase), AWS VM lifecycle, and VM orchestration calls.
 # ✅ Adds: pre-signed S3 URLs so Local Agent never needs AWS creds.
 
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Header, Request, WebSocket, WebSocketDisconnect
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse, Response
+from jose import jwt as jose_jwt, JWTError, ExpiredSignatureError
+from pydantic import BaseModel, ConfigDict, Field, StringConstraints
 
-from aws_manager import AWSManager
+from aws_manager import AWSManager, DescribeInstancesBatcher
 
 import uvicorn
+import anyio
+import asyncio
 import os
-import requests
+import random
+import sys
+import time
+import hashlib
+import hmac
+import logging
+import weakref
+import httpx
+import orjson
 import boto3
-from typing import Optional, Dict, Any
+from botocore.config import Config
+from typing import Annotated, Optional, Dict, Any, List, Tuple
+from urllib.parse import quote
 
 
-app = FastAPI()
+# One canonical path per route; trailing-slash variants are redirected by Starlette.
+app = FastAPI(default_response_class=ORJSONResponse, redirect_slashes=True)
+log = logging.getLogger("cloudram.api")
 aws_manager = AWSManager()
+instance_batcher = DescribeInstancesBatcher(
+    aws_manager,
+    window_seconds=int(os.getenv("DESCRIBE_BATCH_WINDOW_MS", "250")) / 1000,
+    cache_ttl_seconds=float(os.getenv("VM_STATUS_CACHE_TTL_SECONDS", "10")),
+)
 
 # -------------------------
 # CORS (configurable)
@@ -51,6 +73,7 @@ if not SUPABASE_ANON_KEY:
 # VM API Key (optional but recommended)
 # -------------------------
 VM_API_KEY = os.getenv("VM_API_KEY", "")
+_VM_HEADERS = {"X-VM-API-KEY": VM_API_KEY} if VM_API_KEY else {}
 
 # -------------------------
 # S3 Presign config
@@ -76,100 +99,414 @@ ALLOWED_PRESIGN_CONTENT_TYPES = [
     if ct.strip()
 ]
 
-s3_client = boto3.client("s3")
+_boto_session = boto3.session.Session()
+# Membership checks run on every presign; the rejection messages never change.
+ALLOWED_S3_BUCKETS_SET = frozenset(ALLOWED_S3_BUCKETS)
+ALLOWED_PRESIGN_CONTENT_TYPES_SET = frozenset(ALLOWED_PRESIGN_CONTENT_TYPES)
+_BUCKET_ERR_DETAIL = f"Bucket not allowed. Allowed: {', '.join(ALLOWED_S3_BUCKETS)}"
+_CONTENT_TYPE_ERR_DETAIL = f"content_type not allowed. Allowed: {', '.join(ALLOWED_PRESIGN_CONTENT_TYPES)}"
+
+s3_client = _boto_session.client(
+    "s3",
+    config=Config(max_pool_connections=64, retries={"max_attempts": 3, "mode": "adaptive"}),
+)
+
+# FAST_PRESIGN=1 signs URLs in-process with a cached SigV4 key instead of going
+# through botocore's request pipeline. Off by default; generate_presigned_url
+# stays the reference path (and is always used for dotted bucket names).
+FAST_PRESIGN = os.getenv("FAST_PRESIGN", "0") == "1"
+_SIGNING_KEYS: Dict[Tuple[str, str, str], bytes] = {}
+
+
+def _sigv4_signing_key(secret: str, datestamp: str, region: str) -> bytes:
+    """Derive (once per day/region/secret) the SigV4 signing key for S3."""
+    cache_key = (secret, datestamp, region)
+    key = _SIGNING_KEYS.get(cache_key)
+    if key is None:
+        k = hmac.new(("AWS4" + secret).encode(), datestamp.encode(), hashlib.sha256).digest()
+        k = hmac.new(k, region.encode(), hashlib.sha256).digest()
+        k = hmac.new(k, b"s3", hashlib.sha256).digest()
+        key = hmac.new(k, b"aws4_request", hashlib.sha256).digest()
+        _SIGNING_KEYS.clear()  # previous day / rotated secret is no longer needed
+        _SIGNING_KEYS[cache_key] = key
+    return key
+
+
+def _fast_presign(method: str, bucket: str, key: str, expires: int, content_type: Optional[str] = None) -> str:
+    creds = _boto_session.get_credentials().get_frozen_credentials()
+    region = s3_client.meta.region_name or "us-east-1"
+    amz_date = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+    datestamp = amz_date[:8]
+    scope = f"{datestamp}/{region}/s3/aws4_request"
+
+    host = f"{bucket}.s3.{region}.amazonaws.com"
+    uri = "/" + quote(key, safe="/~")
+    if content_type:
+        signed_headers = "content-type;host"
+        canonical_headers = f"content-type:{content_type}\nhost:{host}\n"
+    else:
+        signed_headers = "host"
+        canonical_headers = f"host:{host}\n"
+
+    params = {
+        "X-Amz-Algorithm": "AWS4-HMAC-SHA256",
+        "X-Amz-Credential": f"{creds.access_key}/{scope}",
+        "X-Amz-Date": amz_date,
+        "X-Amz-Expires": str(expires),
+        "X-Amz-SignedHeaders": signed_headers,
+    }
+    if creds.token:
+        params["X-Amz-Security-Token"] = creds.token
+    qs = "&".join(f"{k}={quote(v, safe='~')}" for k, v in sorted(params.items()))
+
+    canonical_request = f"{method}\n{uri}\n{qs}\n{canonical_headers}\n{signed_headers}\nUNSIGNED-PAYLOAD"
+    string_to_sign = (
+        f"AWS4-HMAC-SHA256\n{amz_date}\n{scope}\n"
+        f"{hashlib.sha256(canonical_request.encode()).hexdigest()}"
+    )
+    signature = hmac.new(
+        _sigv4_signing_key(creds.secret_key, datestamp, region),
+        string_to_sign.encode(),
+        hashlib.sha256,
+    ).hexdigest()
+    return f"https://{host}{uri}?{qs}&X-Amz-Signature={signature}"
+
+# -------------------------
+# Verified-token cache (keyed by token hash, never the raw token)
+# -------------------------
+AUTH_CACHE_TTL_SECONDS = float(os.getenv("AUTH_CACHE_TTL_SECONDS", "30"))
+AUTH_NEGATIVE_CACHE_TTL_SECONDS = 2  # absorbs bursts of the same bad token
+AUTH_CACHE_MAX_ENTRIES = 10_000
+_TOKEN_CACHE: Dict[str, Tuple[float, dict]] = {}
+_TOKEN_NEGATIVE_CACHE: Dict[str, Tuple[float, str]] = {}
+
+# -------------------------
+# Local JWT verification (Supabase JWKS)
+#   Asymmetric-signed Supabase tokens are checked in-process; anything that cannot be
+#   decided locally (HS256 projects, unknown kid, JWKS unavailable) falls back to
+#   the /auth/v1/user round-trip above.
+# -------------------------
+SUPABASE_LOCAL_JWT_VERIFY = os.getenv("SUPABASE_LOCAL_JWT_VERIFY", "1") == "1"
+SUPABASE_JWKS_PATH = "/auth/v1/.well-known/jwks.json"
+SUPABASE_JWT_AUDIENCE = os.getenv("SUPABASE_JWT_AUDIENCE", "authenticated")
+JWKS_TTL_SECONDS = float(os.getenv("JWKS_TTL_SECONDS", "600"))
+_JWT_ALGORITHMS = ["RS256", "ES256"]
+_jwks_state: Dict[str, Any] = {"keys": {}, "expires": 0.0, "failures": 0}
+_jwks_lock = asyncio.Lock()
+
+
+# -------------------------
+# Shared async HTTP clients (Supabase / VM calls)
+# -------------------------
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "200"))
+
+
+@app.on_event("startup")
+async def _startup_http_client():
+    # boto3 calls (stop/start/create, waiters) run in anyio's threadpool; the
+    # default 40 tokens is too few when several users wait on VM boots at once.
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    # Supabase speaks HTTP/2: auth lookups multiplex over a few long-lived connections.
+    app.state.supabase = httpx.AsyncClient(
+        http2=True,
+        base_url=SUPABASE_URL,
+        headers={"apikey": SUPABASE_ANON_KEY},
+        timeout=httpx.Timeout(8, connect=2, write=4, pool=2),
+        limits=httpx.Limits(max_keepalive_connections=50, max_connections=100, keepalive_expiry=60),
+    )
+    # VM agents are small HTTP/1.1 Flask servers; the API key header is set once here.
+    app.state.http = httpx.AsyncClient(
+        headers=_VM_HEADERS,
+        timeout=15,
+        limits=httpx.Limits(max_keepalive_connections=100, max_connections=200, keepalive_expiry=30),
+    )
+
+
+@app.on_event("shutdown")
+async def _shutdown_http_client():
+    await app.state.supabase.aclose()
+    await app.state.http.aclose()
+
+
+def _token_cache_key(token: str) -> str:
+    return hashlib.blake2b(token.encode(), digest_size=16).hexdigest()
+
+
+def _token_cache_ttl(exp: Any) -> float:
+    """AUTH_CACHE_TTL_SECONDS, cut short so a cached user never outlives the JWT's exp."""
+    ttl = AUTH_CACHE_TTL_SECONDS
+    if isinstance(exp, (int, float)):
+        # exp is wall-clock epoch seconds; the cache runs on time.monotonic().
+        ttl = min(ttl, exp - time.time())
+    return ttl
+
+
+def _ttl_cache_put(cache: Dict[str, Tuple[float, Any]], key: str, value: Any, ttl: float):
+    now = time.monotonic()
+    if len(cache) >= AUTH_CACHE_MAX_ENTRIES:
+        for k in [k for k, (exp, _) in cache.items() if exp <= now]:
+            del cache[k]
+        if len(cache) >= AUTH_CACHE_MAX_ENTRIES:
+            cache.clear()
+    cache[key] = (now + ttl, value)
+
+
+async def _get_jwks() -> Dict[str, dict]:
+    """Signing keys by kid; refreshed every JWKS_TTL_SECONDS, with jittered backoff on errors."""
+    if time.monotonic() < _jwks_state["expires"]:
+        return _jwks_state["keys"]
+
+    async with _jwks_lock:
+        now = time.monotonic()
+        if now < _jwks_state["expires"]:
+            return _jwks_state["keys"]
+        try:
+            resp = await app.state.supabase.get(SUPABASE_JWKS_PATH, timeout=5)
+            resp.raise_for_status()
+            keys = {k["kid"]: k for k in orjson.loads(resp.content).get("keys", []) if k.get("kid")}
+            _jwks_state.update(keys=keys, expires=now + JWKS_TTL_SECONDS, failures=0)
+        except Exception as e:
+            _jwks_state["failures"] += 1
+            retry_in = 1 + _backoff_delay(_jwks_state["failures"], base=5.0, cap=300.0)
+            _jwks_state["expires"] = now + retry_in
+            log.warning("jwks_refresh_failed error=%s retry_in=%.1fs", e, retry_in)
+    return _jwks_state["keys"]
+
+
+async def _verify_jwt_locally(token: str) -> Optional[Tuple[dict, Any]]:
+    """
+    Return (user, exp claim) for a locally verified token, None if it cannot be decided
+    here. Raises 401 for tokens that are definitely bad (signature/expiry/audience).
+    """
+    if not SUPABASE_LOCAL_JWT_VERIFY:
+        return None
+    try:
+        header = jose_jwt.get_unverified_header(token)
+    except JWTError:
+        return None
+    if header.get("alg") not in _JWT_ALGORITHMS:
+        return None
+    key = (await _get_jwks()).get(header.get("kid"))
+    if key is None:
+        return None
+
+    try:
+        claims = jose_jwt.decode(token, key, algorithms=_JWT_ALGORITHMS, audience=SUPABASE_JWT_AUDIENCE)
+    except ExpiredSignatureError:
+        raise HTTPException(status_code=401, detail="Invalid or expired token: token has expired")
+    except JWTError as e:
+        raise HTTPException(status_code=401, detail=f"Invalid or expired token: {e}")
+
+    if not claims.get("sub"):
+        return None
+    return {
+        "id": claims["sub"],
+        "email": claims.get("email"),
+        "role": claims.get("role"),
+        "app_metadata": claims.get("app_metadata", {}),
+        "user_metadata": claims.get("user_metadata", {}),
+    }, claims.get("exp")
 
 
-def verify_token_raw(token: str) -> dict:
+async def verify_token_raw(token: str) -> dict:
     if not token:
         raise HTTPException(status_code=401, detail="Missing access token")
 
+    cache_key = _token_cache_key(token)
+    now = time.monotonic()
+    cached = _TOKEN_CACHE.get(cache_key)
+    if cached and cached[0] > now:
+        return cached[1]
+    rejected = _TOKEN_NEGATIVE_CACHE.get(cache_key)
+    if rejected and rejected[0] > now:
+        raise HTTPException(status_code=401, detail=rejected[1])
+
     try:
-        resp = requests.get(
-            f"{SUPABASE_URL}/auth/v1/user",
-            headers={
-                "Authorization": f"Bearer {token}",
-                "apikey": SUPABASE_ANON_KEY,
-            },
-            timeout=8,
-        )
-    except requests.RequestException as e:
+        verified = await _verify_jwt_locally(token)
+    except HTTPException as e:
+        _ttl_cache_put(_TOKEN_NEGATIVE_CACHE, cache_key, e.detail, AUTH_NEGATIVE_CACHE_TTL_SECONDS)
+        raise
+    if verified is not None:
+        user, exp = verified
+        ttl = _token_cache_ttl(exp)
+        if ttl > 0:
+            _ttl_cache_put(_TOKEN_CACHE, cache_key, user, ttl)
+        return user
+
+    try:
+        resp = await app.state.supabase.get("/auth/v1/user", headers={"Authorization": f"Bearer {token}"})
+    except httpx.HTTPError as e:
         raise HTTPException(status_code=503, detail=f"Auth service unreachable: {str(e)}")
 
     if resp.status_code != 200:
         try:
-            detail = resp.json()
+            detail = orjson.loads(resp.content)
         except Exception:
             detail = resp.text
-        raise HTTPException(status_code=401, detail=f"Invalid or expired token: {detail}")
+        detail = f"Invalid or expired token: {detail}"
+        _ttl_cache_put(_TOKEN_NEGATIVE_CACHE, cache_key, detail, AUTH_NEGATIVE_CACHE_TTL_SECONDS)
+        raise HTTPException(status_code=401, detail=detail)
 
-    return resp.json()
+    user = orjson.loads(resp.content)
+    # Supabase already vouched for the token; its exp only bounds how long we may reuse that.
+    try:
+        exp = jose_jwt.get_unverified_claims(token).get("exp")
+    except JWTError:
+        exp = None
+    ttl = _token_cache_ttl(exp)
+    if ttl > 0:
+        _ttl_cache_put(_TOKEN_CACHE, cache_key, user, ttl)
+    return user
 
 
 async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    return verify_token_raw(credentials.credentials)
+    return await verify_token_raw(credentials.credentials)
 
 
 # -------------------------
 # Models
 # -------------------------
-class RamRequest(BaseModel):
+class _RequestModel(BaseModel):
+    # Request bodies are read-only once validated.
+    model_config = ConfigDict(frozen=True)
+
+
+class RamRequest(_RequestModel):
     ram_size: int = Field(..., ge=1, le=64)
 
 
-class VmActionRequest(BaseModel):
+class VmActionRequest(_RequestModel):
     vm_id: Optional[str] = None
 
 
-class BeaconStopRequest(BaseModel):
+class BeaconStopRequest(_RequestModel):
     vm_id: str
-    access_token: str
+    # Rejects obviously malformed tokens before they reach Supabase.
+    access_token: Annotated[str, StringConstraints(min_length=20, max_length=4096)]
 
 
-class S3SignPutRequest(BaseModel):
+class S3SignPutRequest(_RequestModel):
     user_id: str
     bucket: str
     key: str
     content_type: str = "application/octet-stream"
 
 
-class S3SignGetRequest(BaseModel):
+class S3SignGetRequest(_RequestModel):
     user_id: str
     bucket: str
     key: str
 
 
+S3_SIGN_BATCH_MAX_ITEMS = int(os.getenv("S3_SIGN_BATCH_MAX_ITEMS", "500"))
+
+
+class S3SignPutBatchRequest(_RequestModel):
+    items: List[S3SignPutRequest] = Field(..., min_length=1, max_length=S3_SIGN_BATCH_MAX_ITEMS)
+
+
+class S3SignGetBatchRequest(_RequestModel):
+    items: List[S3SignGetRequest] = Field(..., min_length=1, max_length=S3_SIGN_BATCH_MAX_ITEMS)
+
+
+class VscodeSetupCallback(_RequestModel):
+    job_id: str
+    status: str
+    message: Optional[str] = None
+    user_id: Optional[str] = None
+    finished_at: Optional[str] = None
+
+
 # -------------------------
 # Helpers: talk to VM
 # -------------------------
-def _vm_headers() -> Dict[str, str]:
-    headers: Dict[str, str] = {}
-    if VM_API_KEY:
-        headers["X-VM-API-KEY"] = VM_API_KEY
-    return headers
+# Each VM runs a single small Flask agent: cap in-flight calls per VM so bursts queue here
+# instead of piling up on the VM.
+VM_FANOUT_CONCURRENCY = int(os.getenv("VM_FANOUT_CONCURRENCY", "4"))
+# Weak values: a VM's semaphore lives only while calls to it hold or wait on it, so
+# caller-supplied vm_ip values can't grow this without bound.
+_vm_semaphores: "weakref.WeakValueDictionary[str, asyncio.Semaphore]" = weakref.WeakValueDictionary()
+# Global cap on outbound VM calls across all VMs (protects against refresh storms).
+VM_HTTP_SEMAPHORE = asyncio.Semaphore(int(os.getenv("VM_HTTP_CONCURRENCY", "200")))
+
+
+def _vm_semaphore(vm_ip: str) -> asyncio.Semaphore:
+    sem = _vm_semaphores.get(vm_ip)
+    if sem is None:
+        sem = _vm_semaphores[vm_ip] = asyncio.Semaphore(VM_FANOUT_CONCURRENCY)
+    return sem
 
 
-def _vm_post(vm_ip: str, path: str, payload: Dict[str, Any], timeout: int = 30) -> requests.Response:
+async def _vm_post(vm_ip: str, path: str, payload: Dict[str, Any], timeout: int = 30) -> httpx.Response:
     url = f"http://{vm_ip}:5000{path}"
     try:
-        return requests.post(url, json=payload, headers=_vm_headers(), timeout=timeout)
-    except requests.RequestException as e:
+        async with _vm_semaphore(vm_ip), VM_HTTP_SEMAPHORE:
+            return await app.state.http.post(url, json=payload, timeout=timeout)
+    except httpx.HTTPError as e:
         raise HTTPException(status_code=503, detail=f"VM unreachable: {str(e)}")
 
 
-def _vm_get(vm_ip: str, path: str, timeout: int = 15) -> requests.Response:
+async def _vm_get(vm_ip: str, path: str, timeout: int = 15) -> httpx.Response:
     url = f"http://{vm_ip}:5000{path}"
     try:
-        return requests.get(url, headers=_vm_headers(), timeout=timeout)
-    except requests.RequestException as e:
+        async with _vm_semaphore(vm_ip), VM_HTTP_SEMAPHORE:
+            return await app.state.http.get(url, timeout=timeout)
+    except httpx.HTTPError as e:
         raise HTTPException(status_code=503, detail=f"VM unreachable: {str(e)}")
 
 
+def _backoff_delay(attempt: int, base: float = 1.0, cap: float = 30.0) -> float:
+    """Exponential backoff with full jitter: uniform(0, min(cap, base * 2**attempt))."""
+    return random.uniform(0, min(cap, base * (2 ** min(attempt, 5))))
+
+
+async def _wait_for_vm_ready(vm_ip: str, timeout: float = 600, request: Optional[Request] = None) -> bool:
+    """
+    Poll the VM agent (GET /) without blocking the event loop, backing off with jitter.
+    Gives up early (False) if the waiting HTTP client has gone away.
+    """
+    async def _poll() -> bool:
+        attempt = 0
+        while True:
+            if request is not None and await request.is_disconnected():
+                return False
+            try:
+                resp = await _vm_get(vm_ip, "/", timeout=5)
+                if resp.status_code == 200:
+                    return True
+            except HTTPException:
+                pass  # VM not reachable yet
+            await asyncio.sleep(_backoff_delay(attempt))
+            attempt += 1
+
+    try:
+        return await asyncio.wait_for(_poll(), timeout=timeout)
+    except asyncio.TimeoutError:
+        return False
+
+
+async def _wait_for_public_ip(vm_id: str, timeout: float = 240) -> str:
+    """Return the instance's public IP as soon as EC2 assigns one (pending or running)."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    attempt = 0
+    while loop.time() < deadline:
+        state, ip = await run_in_threadpool(aws_manager.get_instance_state_and_ip, vm_id)
+        if ip and state in ("pending", "running"):
+            return ip
+        if state in ("shutting-down", "terminated"):
+            raise RuntimeError(f"Instance is {state}.")
+        await asyncio.sleep(min(1 + _backoff_delay(attempt, cap=5.0), max(0, deadline - loop.time())))
+        attempt += 1
+    raise RuntimeError("Timed out waiting for a public IP.")
+
+
 # -------------------------
 # Helpers: S3 presign safety
 # -------------------------
 def _require_user_scoped_key(user_id: str, key: str):
     expected_prefix = f"users/{user_id}/"
-    if not key or not key.startswith(expected_prefix):
+    if not key.startswith(expected_prefix):
         raise HTTPException(
             status_code=403,
             detail=f"Invalid key scope. Key must start with '{expected_prefix}'",
@@ -177,37 +514,55 @@ def _require_user_scoped_key(user_id: str, key: str):
 
 
 def _require_allowed_bucket(bucket: str):
-    if bucket not in ALLOWED_S3_BUCKETS:
-        raise HTTPException(
-            status_code=403,
-            detail=f"Bucket not allowed. Allowed: {', '.join(ALLOWED_S3_BUCKETS)}",
-        )
+    if bucket not in ALLOWED_S3_BUCKETS_SET:
+        raise HTTPException(status_code=403, detail=_BUCKET_ERR_DETAIL)
 
 
 def _require_allowed_content_type(content_type: str):
     ct = (content_type or "").strip()
-    if ct not in ALLOWED_PRESIGN_CONTENT_TYPES:
-        raise HTTPException(
-            status_code=400,
-            detail=f"content_type not allowed. Allowed: {', '.join(ALLOWED_PRESIGN_CONTENT_TYPES)}",
-        )
+    if ct not in ALLOWED_PRESIGN_CONTENT_TYPES_SET:
+        raise HTTPException(status_code=400, detail=_CONTENT_TYPE_ERR_DETAIL)
+
+
+# -------------------------
+# Helpers: resolve caller / VM
+# -------------------------
+def _require_user_id(user: dict) -> str:
+    user_id = user.get("id")
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Invalid user payload (missing id)")
+    return user_id
+
+
+async def _resolve_vm(user: dict, req: VmActionRequest) -> Tuple[str, dict, str]:
+    """Return (user_id, instance, vm_id) for a VM action; 401/404 if there is none."""
+    user_id = _require_user_id(user)
+    inst = await instance_batcher.get(user_id)
+    if not inst:
+        raise HTTPException(status_code=404, detail="No VM found for this user.")
+    return user_id, inst, req.vm_id or inst["InstanceId"]
 
 
 # -------------------------
 # Basic endpoints
 # -------------------------
-@app.get("/health")
-async def health_check():
-    return {"status": "healthy"}
+_HEALTH_BODY = b'{"status":"healthy"}'
+
+
+# Liveness probes hit this constantly: register it as a bare Starlette route so it
+# skips FastAPI's dependency resolution, validation and JSON encoding.
+async def health_check(request: Request) -> Response:
+    return Response(_HEALTH_BODY, media_type="application/json")
+
+
+app.add_route("/health", health_check, methods=["GET"], include_in_schema=False)
 
 
 @app.get("/my_vm")
 async def my_vm(user: dict = Depends(verify_token)):
-    user_id = user.get("id")
-    if not user_id:
-        raise HTTPException(status_code=401, detail="Invalid user payload (missing id)")
+    user_id = _require_user_id(user)
 
-    inst = aws_manager.find_user_instance(user_id)
+    inst = await instance_batcher.get(user_id)
     if not inst:
         return {"exists": False}
 
@@ -223,21 +578,20 @@ async def my_vm(user: dict = Depends(verify_token)):
 # ✅ S3 Presigned URLs (for Local Agent)
 #   Local Agent sends SB token to backend, backend signs per-user object URL.
 # =========================
-@app.post("/s3/sign_put")
-async def s3_sign_put(req: S3SignPutRequest, user: dict = Depends(verify_token)):
-    token_user_id = user.get("id")
-    if not token_user_id:
-        raise HTTPException(status_code=401, detail="Invalid user payload (missing id)")
-
-    if req.user_id != token_user_id:
+def _require_token_user(user: dict, user_id: str):
+    if user_id != _require_user_id(user):
         raise HTTPException(status_code=403, detail="user_id mismatch")
 
+
+def _presign_put_url(req: S3SignPutRequest) -> str:
     _require_allowed_bucket(req.bucket)
     _require_user_scoped_key(req.user_id, req.key)
     _require_allowed_content_type(req.content_type)
 
     try:
-        url = s3_client.generate_presigned_url(
+        if FAST_PRESIGN and "." not in req.bucket:
+            return _fast_presign("PUT", req.bucket, req.key, S3_PRESIGN_EXPIRES_SECONDS, req.content_type)
+        return s3_client.generate_presigned_url(
             ClientMethod="put_object",
             Params={
                 "Bucket": req.bucket,
@@ -249,6 +603,28 @@ async def s3_sign_put(req: S3SignPutRequest, user: dict = Depends(verify_token))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to presign PUT URL: {str(e)}")
 
+
+def _presign_get_url(req: S3SignGetRequest) -> str:
+    _require_allowed_bucket(req.bucket)
+    _require_user_scoped_key(req.user_id, req.key)
+
+    try:
+        if FAST_PRESIGN and "." not in req.bucket:
+            return _fast_presign("GET", req.bucket, req.key, S3_PRESIGN_EXPIRES_SECONDS)
+        return s3_client.generate_presigned_url(
+            ClientMethod="get_object",
+            Params={"Bucket": req.bucket, "Key": req.key},
+            ExpiresIn=S3_PRESIGN_EXPIRES_SECONDS,
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to presign GET URL: {str(e)}")
+
+
+@app.post("/s3/sign_put")
+async def s3_sign_put(req: S3SignPutRequest, user: dict = Depends(verify_token)):
+    _require_token_user(user, req.user_id)
+    url = _presign_put_url(req)
+
     return {
         "url": url,
         "bucket": req.bucket,
@@ -259,26 +635,43 @@ async def s3_sign_put(req: S3SignPutRequest, user: dict = Depends(verify_token))
 
 @app.post("/s3/sign_get")
 async def s3_sign_get(req: S3SignGetRequest, user: dict = Depends(verify_token)):
-    token_user_id = user.get("id")
-    if not token_user_id:
-        raise HTTPException(status_code=401, detail="Invalid user payload (missing id)")
+    _require_token_user(user, req.user_id)
+    url = _presign_get_url(req)
 
-    if req.user_id != token_user_id:
-        raise HTTPException(status_code=403, detail="user_id mismatch")
+    return {"url": url, "expires_in": S3_PRESIGN_EXPIRES_SECONDS}
 
-    _require_allowed_bucket(req.bucket)
-    _require_user_scoped_key(req.user_id, req.key)
 
-    try:
-        url = s3_client.generate_presigned_url(
-            ClientMethod="get_object",
-            Params={"Bucket": req.bucket, "Key": req.key},
-            ExpiresIn=S3_PRESIGN_EXPIRES_SECONDS,
-        )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to presign GET URL: {str(e)}")
+# Batch variants: one round-trip per project upload/download instead of one per object.
+# Signing is CPU-bound (and holds the GIL), so the whole batch is signed in a single
+# threadpool hop rather than one hop per item.
+@app.post("/s3/sign_put_batch")
+async def s3_sign_put_batch(req: S3SignPutBatchRequest, user: dict = Depends(verify_token)):
+    for item in req.items:
+        _require_token_user(user, item.user_id)
 
-    return {"url": url, "expires_in": S3_PRESIGN_EXPIRES_SECONDS}
+    urls = await run_in_threadpool(lambda: [_presign_put_url(item) for item in req.items])
+    return {
+        "items": [
+            {"url": url, "bucket": item.bucket, "key": item.key}
+            for item, url in zip(req.items, urls)
+        ],
+        "expires_in": S3_PRESIGN_EXPIRES_SECONDS,
+    }
+
+
+@app.post("/s3/sign_get_batch")
+async def s3_sign_get_batch(req: S3SignGetBatchRequest, user: dict = Depends(verify_token)):
+    for item in req.items:
+        _require_token_user(user, item.user_id)
+
+    urls = await run_in_threadpool(lambda: [_presign_get_url(item) for item in req.items])
+    return {
+        "items": [
+            {"url": url, "bucket": item.bucket, "key": item.key}
+            for item, url in zip(req.items, urls)
+        ],
+        "expires_in": S3_PRESIGN_EXPIRES_SECONDS,
+    }
 
 
 # =========================
@@ -286,16 +679,10 @@ async def s3_sign_get(req: S3SignGetRequest, user: dict = Depends(verify_token))
 # =========================
 @app.post("/stop_vm")
 async def stop_vm(req: VmActionRequest, user: dict = Depends(verify_token)):
-    user_id = user.get("id")
-    if not user_id:
-        raise HTTPException(status_code=401, detail="Invalid user payload (missing id)")
-
-    inst = aws_manager.find_user_instance(user_id)
-    if not inst:
-        raise HTTPException(status_code=404, detail="No VM found for this user.")
-
-    vm_id = req.vm_id or inst["InstanceId"]
-    ok = aws_manager.stop_vm(vm_id)
+    user_id, inst, vm_id = await _resolve_vm(user, req)
+    log.info("stop_request source=button user=%s vm_id=%s state=%s", user_id, vm_id, inst["State"]["Name"])
+    ok = await run_in_threadpool(aws_manager.stop_vm, vm_id)
+    instance_batcher.invalidate(user_id)
     if not ok:
         raise HTTPException(status_code=500, detail="Failed to stop VM.")
     return {"message": f"Stopping VM {vm_id}."}
@@ -306,43 +693,47 @@ async def stop_vm(req: VmActionRequest, user: dict = Depends(verify_token)):
 # =========================
 @app.post("/stop_vm_beacon")
 async def stop_vm_beacon(req: BeaconStopRequest):
-    user = verify_token_raw(req.access_token)
-    user_id = user.get("id")
-    if not user_id:
-        raise HTTPException(status_code=401, detail="Invalid user payload (missing id)")
+    user = await verify_token_raw(req.access_token)
+    user_id = _require_user_id(user)
 
-    inst = aws_manager.find_user_instance(user_id)
+    inst = await instance_batcher.get(user_id)
     if not inst:
         return {"message": "No VM found for this user."}
 
     vm_id = req.vm_id or inst["InstanceId"]
-    ok = aws_manager.stop_vm(vm_id)
+    log.info("stop_request source=beacon user=%s vm_id=%s state=%s", user_id, vm_id, inst["State"]["Name"])
+    ok = await run_in_threadpool(aws_manager.stop_vm, vm_id)
+    instance_batcher.invalidate(user_id)
     if not ok:
         raise HTTPException(status_code=500, detail="Failed to stop VM.")
     return {"message": f"Stopping VM {vm_id}."}
 
 
 @app.post("/start_vm")
-async def start_vm(req: VmActionRequest, user: dict = Depends(verify_token)):
-    user_id = user.get("id")
-    if not user_id:
-        raise HTTPException(status_code=401, detail="Invalid user payload (missing id)")
-
-    inst = aws_manager.find_user_instance(user_id)
-    if not inst:
-        raise HTTPException(status_code=404, detail="No VM found for this user.")
-
-    vm_id = req.vm_id or inst["InstanceId"]
-    ok = aws_manager.start_vm(vm_id)
+async def start_vm(req: VmActionRequest, request: Request, user: dict = Depends(verify_token)):
+    user_id, inst, vm_id = await _resolve_vm(user, req)
+    ok = await run_in_threadpool(aws_manager.start_vm, vm_id)
+    instance_batcher.invalidate(user_id)
     if not ok:
         raise HTTPException(status_code=500, detail="Failed to start VM.")
 
+    # A public IP is assigned while the instance is still pending, so start
+    # probing the agent as soon as it is known and overlap it with the wait
+    # for the "running" state instead of doing the two phases back to back.
     try:
-        ip = aws_manager.wait_for_running_and_ip(vm_id)
+        ip = await _wait_for_public_ip(vm_id)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"VM start timed out: {str(e)}")
 
-    services_ok = aws_manager.wait_for_vm_services(ip_address=ip, max_attempts=60)
+    health_task = asyncio.create_task(_wait_for_vm_ready(ip, timeout=600, request=request))
+    try:
+        running_ip = await run_in_threadpool(aws_manager.wait_for_running_and_ip, vm_id)
+    except Exception as e:
+        health_task.cancel()
+        raise HTTPException(status_code=500, detail=f"VM start timed out: {str(e)}")
+
+    ip = running_ip or ip
+    services_ok = await health_task
     if not services_ok:
         raise HTTPException(status_code=500, detail="VM started but services not ready in time.")
 
@@ -351,16 +742,9 @@ async def start_vm(req: VmActionRequest, user: dict = Depends(verify_token)):
 
 @app.post("/terminate_vm")
 async def terminate_vm(req: VmActionRequest, user: dict = Depends(verify_token)):
-    user_id = user.get("id")
-    if not user_id:
-        raise HTTPException(status_code=401, detail="Invalid user payload (missing id)")
-
-    inst = aws_manager.find_user_instance(user_id)
-    if not inst:
-        raise HTTPException(status_code=404, detail="No VM found for this user.")
-
-    vm_id = req.vm_id or inst["InstanceId"]
-    ok = aws_manager.terminate_vm(vm_id)
+    user_id, inst, vm_id = await _resolve_vm(user, req)
+    ok = await run_in_threadpool(aws_manager.terminate_vm, vm_id)
+    instance_batcher.invalidate(user_id)
     if not ok:
         raise HTTPException(status_code=500, detail="Failed to terminate VM.")
 
@@ -371,13 +755,10 @@ async def terminate_vm(req: VmActionRequest, user: dict = Depends(verify_token))
 # ✅ Allocate / Resume logic
 # =========================
 @app.post("/allocate")
-@app.post("/allocate/")
 async def allocate_ram(request: RamRequest, user: dict = Depends(verify_token)):
-    user_id = user.get("id")
-    if not user_id:
-        raise HTTPException(status_code=401, detail="Invalid user payload (missing id)")
+    user_id = _require_user_id(user)
 
-    existing = aws_manager.find_user_instance(user_id)
+    existing = await instance_batcher.get(user_id)
     if existing:
         vm_id = existing["InstanceId"]
         state = existing["State"]["Name"]
@@ -396,9 +777,11 @@ async def allocate_ram(request: RamRequest, user: dict = Depends(verify_token)):
             }
 
     try:
-        vm_id, ip_address = aws_manager.create_vm(request.ram_size, user_id=user_id)
+        vm_id, ip_address = await run_in_threadpool(aws_manager.create_vm, request.ram_size, user_id=user_id)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to allocate RAM: {str(e)}")
+    finally:
+        instance_batcher.invalidate(user_id)
 
     if not vm_id or not ip_address:
         raise HTTPException(status_code=500, detail="Failed to allocate RAM (no vm_id/ip).")
@@ -406,20 +789,142 @@ async def allocate_ram(request: RamRequest, user: dict = Depends(verify_token)):
     return {"vm_id": vm_id, "ip": ip_address, "state": "running"}
 
 
+# =========================
+# ✅ VSCode setup completion (push instead of polling)
+#   VM agent POSTs terminal job status here; clients wait on a WebSocket.
+#   The rendezvous is in-process memory: the callback and the WebSocket must reach the
+#   same worker, so this push path requires WEB_CONCURRENCY=1.
+# =========================
+VSCODE_SETUP_WAIT_SECONDS = 300
+# Results no WebSocket collected (client gone, or never connected) are dropped after this.
+VSCODE_SETUP_RESULT_TTL_SECONDS = float(os.getenv("VSCODE_SETUP_RESULT_TTL_SECONDS", "600"))
+# One Event per job, shared by every socket waiting on it (a reconnecting client may
+# briefly have two); dropped when the last waiter leaves.
+_vscode_setup_events: Dict[str, asyncio.Event] = {}
+_vscode_setup_waiters: Dict[str, int] = {}
+_vscode_setup_results: Dict[str, Tuple[float, dict]] = {}  # job_id -> (expires_at, result)
+
+
+def _prune_vscode_setup_results(now: float) -> None:
+    for job_id in [j for j, (expires_at, _) in _vscode_setup_results.items() if expires_at <= now]:
+        del _vscode_setup_results[job_id]
+
+
+def _vscode_setup_result(job_id: str) -> Optional[dict]:
+    entry = _vscode_setup_results.get(job_id)
+    if entry is None:
+        return None
+    if entry[0] <= time.monotonic():
+        _vscode_setup_results.pop(job_id, None)
+        return None
+    return entry[1]
+
+
+async def _wait_for_setup_or_disconnect(websocket: WebSocket, event: asyncio.Event, timeout: float) -> str:
+    """
+    Wait for the job's callback while watching the socket, so a client that goes away
+    stops the wait. Returns "done", "timeout" or "disconnected"; client messages are ignored.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    waiter = asyncio.ensure_future(event.wait())
+    receiver = None
+    try:
+        while True:
+            receiver = asyncio.ensure_future(websocket.receive())
+            done, _ = await asyncio.wait(
+                {waiter, receiver},
+                timeout=max(0.0, deadline - loop.time()),
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if waiter in done:
+                return "done"
+            if receiver not in done:
+                return "timeout"
+            if receiver.exception() is not None or receiver.result().get("type") == "websocket.disconnect":
+                return "disconnected"
+    finally:
+        for task in (waiter, receiver):
+            if task is not None and not task.done():
+                task.cancel()
+
+
+@app.post("/vscode/setup_callback")
+async def vscode_setup_callback(req: VscodeSetupCallback, x_vm_api_key: Optional[str] = Header(None)):
+    # Authenticated by VM_API_KEY only; without a configured key nobody may post results.
+    if not VM_API_KEY:
+        raise HTTPException(status_code=503, detail="VM_API_KEY not configured")
+    if not hmac.compare_digest((x_vm_api_key or "").encode(), VM_API_KEY.encode()):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    now = time.monotonic()
+    _prune_vscode_setup_results(now)
+    _vscode_setup_results[req.job_id] = (now + VSCODE_SETUP_RESULT_TTL_SECONDS, req.model_dump())
+    event = _vscode_setup_events.get(req.job_id)
+    if event is not None:
+        event.set()
+    return {"ok": True}
+
+
+@app.websocket("/ws/vscode_setup/{job_id}")
+async def ws_vscode_setup(websocket: WebSocket, job_id: str, token: str = ""):
+    await websocket.accept()
+    try:
+        user = await verify_token_raw(token)
+    except HTTPException as e:
+        await websocket.send_json({"status": "error", "message": e.detail})
+        await websocket.close(code=4401)
+        return
+
+    event = _vscode_setup_events.setdefault(job_id, asyncio.Event())
+    _vscode_setup_waiters[job_id] = _vscode_setup_waiters.get(job_id, 0) + 1
+    try:
+        # The callback may already have landed before the socket connected.
+        if _vscode_setup_result(job_id) is None:
+            outcome = await _wait_for_setup_or_disconnect(websocket, event, VSCODE_SETUP_WAIT_SECONDS)
+            if outcome == "disconnected":
+                return
+            if outcome == "timeout":
+                await websocket.send_json({"job_id": job_id, "status": "timeout", "message": "VSCode setup timed out"})
+                await websocket.close()
+                return
+
+        # Ownership is checked without consuming anything: a stranger's socket must not
+        # cost the owner their result.
+        result = _vscode_setup_result(job_id) or {}
+        if result.get("user_id") != user.get("id"):
+            await websocket.send_json({"job_id": job_id, "status": "error", "message": "job belongs to another user"})
+            await websocket.close(code=4403)
+            return
+
+        await websocket.send_json(result)
+        # Delivered to its owner: only now is the result consumed. Anything not delivered
+        # (timeouts, disconnects, wrong user) is left to VSCODE_SETUP_RESULT_TTL_SECONDS.
+        _vscode_setup_results.pop(job_id, None)
+        await websocket.close()
+    except WebSocketDisconnect:
+        return
+    finally:
+        remaining = _vscode_setup_waiters.pop(job_id, 1) - 1
+        if remaining > 0:
+            _vscode_setup_waiters[job_id] = remaining
+        elif _vscode_setup_events.get(job_id) is event:
+            del _vscode_setup_events[job_id]
+
+
 # =========================
 # ✅ VM RAM usage (from VM)
 # =========================
 @app.get("/ram_usage")
-@app.get("/ram_usage/")
 async def ram_usage(vm_ip: str, user: dict = Depends(verify_token)):
     if not vm_ip:
         raise HTTPException(status_code=400, detail="VM IP is required")
 
-    resp = _vm_get(vm_ip, "/ram_usage", timeout=12)
+    resp = await _vm_get(vm_ip, "/ram_usage", timeout=12)
     if resp.status_code != 200:
         raise HTTPException(status_code=502, detail=f"VM ram_usage failed: {resp.status_code} {resp.text}")
 
-    data = resp.json()
+    data = orjson.loads(resp.content)
     return {
         "total_ram": data.get("total_ram", 0),
         "used_ram": data.get("used_ram", 0),
@@ -430,4 +935,21 @@ async def ram_usage(vm_ip: str, user: dict = Depends(verify_token)):
 
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # Auth/instance caches and the VSCode setup rendezvous live in process
+    # memory, so keep a single worker unless WEB_CONCURRENCY says otherwise.
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    if workers > 1:
+        log.warning(
+            "WEB_CONCURRENCY=%d: /ws/vscode_setup push needs a single worker "
+            "(callback and socket may land on different processes)", workers,
+        )
+    fast_stack = sys.platform.startswith("linux")
+    uvicorn.run(
+        "main:app" if workers > 1 else app,
+        host="0.0.0.0",
+        port=port,
+        workers=workers,
+        loop="uvloop" if fast_stack else "auto",
+        http="httptools" if fast_stack else "auto",
+        access_log=os.getenv("ACCESS_LOG", "0") == "1",
+    )
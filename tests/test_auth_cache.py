@@ -0,0 +1,66 @@
+import asyncio
+import os
+import time
+from types import SimpleNamespace
+
+import pytest
+
+os.environ.setdefault("SUPABASE_ANON_KEY", "test-anon-key")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+pytest.importorskip("fastapi")
+jose_jwt = pytest.importorskip("jose.jwt")
+orjson = pytest.importorskip("orjson")
+
+import main  # noqa: E402
+
+
+class _FakeSupabase:
+    def __init__(self, user):
+        self.user = user
+        self.calls = 0
+
+    async def get(self, path, headers=None, **kwargs):
+        self.calls += 1
+        return SimpleNamespace(status_code=200, content=orjson.dumps(self.user), text="")
+
+
+@pytest.fixture
+def supabase(monkeypatch):
+    fake = _FakeSupabase({"id": "user-1"})
+    monkeypatch.setattr(main, "SUPABASE_LOCAL_JWT_VERIFY", False)
+    monkeypatch.setattr(main.app.state, "supabase", fake, raising=False)
+    monkeypatch.setattr(main, "_TOKEN_CACHE", {})
+    monkeypatch.setattr(main, "_TOKEN_NEGATIVE_CACHE", {})
+    return fake
+
+
+def test_cache_entry_capped_at_token_exp(supabase):
+    exp_in = 5
+    assert exp_in < main.AUTH_CACHE_TTL_SECONDS
+    token = jose_jwt.encode({"sub": "user-1", "exp": int(time.time()) + exp_in}, "secret", algorithm="HS256")
+
+    user = asyncio.run(main.verify_token_raw(token))
+
+    assert user == {"id": "user-1"}
+    expires_at, _ = main._TOKEN_CACHE[main._token_cache_key(token)]
+    assert expires_at <= time.monotonic() + exp_in
+    assert expires_at < time.monotonic() + main.AUTH_CACHE_TTL_SECONDS - 1
+
+
+def test_expired_token_not_served_from_cache(supabase, monkeypatch):
+    token = jose_jwt.encode({"sub": "user-1", "exp": int(time.time()) + 5}, "secret", algorithm="HS256")
+    asyncio.run(main.verify_token_raw(token))
+    assert supabase.calls == 1
+
+    # Jump past exp (but well inside AUTH_CACHE_TTL_SECONDS): the cache must not answer.
+    real_monotonic = time.monotonic
+    monkeypatch.setattr(main.time, "monotonic", lambda: real_monotonic() + 10)
+    asyncio.run(main.verify_token_raw(token))
+    assert supabase.calls == 2
+
+
+def test_token_already_expired_is_not_cached(supabase):
+    token = jose_jwt.encode({"sub": "user-1", "exp": int(time.time()) - 1}, "secret", algorithm="HS256")
+    asyncio.run(main.verify_token_raw(token))
+    assert main._token_cache_key(token) not in main._TOKEN_CACHE
@@ -15,18 +15,46 @@ import psutil
 import subprocess
 import boto3
 import botocore
+from botocore.config import Config as BotoConfig
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
 import time
 from watchdog.observers import Observer
+from watchdog.observers.polling import PollingObserver
 from watchdog.events import FileSystemEventHandler
 import threading
 import sys
 import logging
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import zipfile
+import zlib
+import io
+import mmap
 import shutil
+import stat
 import uuid
-from datetime import datetime
+import ctypes
+from ctypes import wintypes
+import venv
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
 import json
+import re
+import hashlib
+import hmac
+from collections import deque
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # older VM images; stdlib json still works
+    orjson = None
+
+try:
+    from isal import isal_zlib  # SIMD DEFLATE for export zips (IsalZipFile)
+except ImportError:  # stock zlib DEFLATE
+    isal_zlib = None
 
 
 # ----------------------------
@@ -44,7 +72,20 @@ logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
+if orjson is not None:
+    class ORJSONProvider(DefaultJSONProvider):
+        """jsonify/request.get_json through orjson (C) instead of the stdlib encoder."""
+
+        def dumps(self, obj, **kwargs):
+            return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode()
+
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
+
+    app.json = ORJSONProvider(app)
+
 VM_API_KEY = os.getenv("VM_API_KEY")  # required in production
+_VM_API_KEY_BYTES = VM_API_KEY.encode("utf-8") if VM_API_KEY else None
 
 # ----------------------------
 # Existing Notepad Sync Config
@@ -52,8 +93,11 @@ VM_API_KEY = os.getenv("VM_API_KEY")  # required in production
 
 BUCKET_NAME = os.getenv("NOTEPAD_BUCKET_NAME", "notepadfiles")
 SYNCED_DIR = os.getenv("SYNCED_DIR", fr"C:\Users\vm_user\SyncedNotepadFiles")
+SYNCED_EXTS = frozenset({".txt", ".cpp", ".py", ".html"})
 VSCODE_BUCKET_NAME = os.getenv("VSCODE_BUCKET_NAME", "cloudram-vscode")
 AWS_DEFAULT_REGION = os.getenv("AWS_DEFAULT_REGION", "us-east-1")
+BACKEND_CALLBACK_URL = os.getenv("BACKEND_CALLBACK_URL")  # e.g. https://<backend>/vscode/setup_callback
+SYNC_STATE_FILE = os.getenv("SYNC_STATE_FILE", r"C:\CloudRAM\notepad_sync_state.json")
 
 # ----------------------------
 # AWS Session from env creds
@@ -67,7 +111,39 @@ if credentials is None:
 else:
     logger.info("AWS credentials loaded from environment.")
 
-s3 = session.client('s3')
+# The one S3 client for the whole agent. Its pool covers the transfer manager's 16
+# workers plus concurrent exports (4 parts in flight each) and setup downloads.
+# Adaptive retries (as the backend's EC2/S3 clients use) back off together when a
+# burst gets throttled.
+s3 = session.client('s3', config=BotoConfig(
+    max_pool_connections=64,
+    retries={"max_attempts": 5, "mode": "adaptive"},
+    tcp_keepalive=True,
+))
+
+# Multipart transfers: large project zips move as parallel 16 MiB parts.
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=16 * 1024 * 1024,
+    max_concurrency=16,
+    max_io_queue=1000,
+    use_threads=True,
+)
+# One long-lived transfer pool: batches of small Notepad files go out/in concurrently
+# instead of one blocking round-trip per file.
+transfer_manager = create_transfer_manager(s3, S3_TRANSFER_CONFIG)
+
+# ----------------------------
+# Outbound HTTP (backend callbacks): one pooled keep-alive session
+# ----------------------------
+http = requests.Session()
+_http_adapter = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504]),
+)
+http.mount("http://", _http_adapter)
+http.mount("https://", _http_adapter)
 
 # ----------------------------
 # Notepad++ possible paths
@@ -80,6 +156,33 @@ NOTEPAD_PATHS = [
 # In-memory task tracking
 running_tasks = {}
 vscode_jobs = {}  # job_id -> {status, message, started_at, finished_at, project_name}
+# /setup_vscode jobs are CPU/disk heavy (unzip, pip); cap how many run at once so a burst
+# of setups doesn't starve the request threads. Extra jobs wait their turn in the queue.
+VSCODE_SETUP_WORKERS = int(os.getenv("VSCODE_SETUP_WORKERS", "2"))
+vscode_setup_pool = ThreadPoolExecutor(max_workers=VSCODE_SETUP_WORKERS, thread_name_prefix="vscode-setup")
+
+# Project exports run the same way: zip + upload off the request thread, polled by job id.
+export_jobs = {}
+EXPORT_WORKERS = int(os.getenv("EXPORT_WORKERS", "4"))
+export_pool = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix="export")
+
+# Finished jobs stay pollable for this long, then are dropped when the next job is queued.
+JOB_RESULT_TTL_SECONDS = int(os.getenv("JOB_RESULT_TTL_SECONDS", "3600"))
+
+def prune_finished_jobs(jobs: dict):
+    """Remove jobs that finished more than JOB_RESULT_TTL_SECONDS ago (running ones stay)."""
+    now = datetime.utcnow()
+    for job_id, job in list(jobs.items()):
+        finished_at = job.get("finished_at")
+        if not finished_at:
+            continue
+        try:
+            age = (now - datetime.fromisoformat(finished_at.rstrip("Z"))).total_seconds()
+        except ValueError:
+            continue
+        if age > JOB_RESULT_TTL_SECONDS:
+            jobs.pop(job_id, None)
+
 # Track open files in Notepad++
 open_notepad_files = set()
 
@@ -89,19 +192,154 @@ open_notepad_files = set()
 VSCODE_BASE_DIR = r"C:\CloudRAM\VSCode"
 VSCODE_DOWNLOADS_DIR = os.path.join(VSCODE_BASE_DIR, "downloads")
 VSCODE_PROJECTS_DIR = os.path.join(VSCODE_BASE_DIR, "projects")
-VSCODE_CFG_DIR = os.path.join(VSCODE_BASE_DIR, "cfg")
+VSCODE_TRASH_DIR = os.path.join(VSCODE_BASE_DIR, "trash")
+VSCODE_PARKED_VENVS_DIR = os.path.join(VSCODE_BASE_DIR, "parked_venvs")
+
+# Resolved once at startup; the agent's environment doesn't change while it runs.
+# (fallback: typical Administrator roaming path)
+_APPDATA = os.environ.get("APPDATA") or r"C:\Users\Administrator\AppData\Roaming"
+VSCODE_USER_DIR = os.path.join(_APPDATA, "Code", "User")
+SCHTASKS_EXE = shutil.which("schtasks") or r"C:\Windows\System32\schtasks.exe"
 
 
 
+_known_dirs = set()  # directories this agent has already created/confirmed
+_known_dirs_lock = threading.Lock()
+
 def ensure_dir(path: str):
+    """makedirs(exist_ok=True), but only the first time a given directory is asked for."""
+    if path in _known_dirs:
+        return
     os.makedirs(path, exist_ok=True)
+    with _known_dirs_lock:
+        _known_dirs.add(path)
 
-def unzip(zip_path: str, dest_dir: str):
+def _forget_dirs(path: str):
+    # `path` is being moved/deleted: it and anything cached under it must be re-created.
+    prefix = os.path.join(path, "")
+    with _known_dirs_lock:
+        _known_dirs.difference_update([d for d in _known_dirs if d == path or d.startswith(prefix)])
+
+def _empty_trash():
+    with os.scandir(VSCODE_TRASH_DIR) as it:
+        for entry in list(it):
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+def discard_dir(path: str):
+    """
+    Get `path` out of the way immediately: rename it into VSCODE_TRASH_DIR (same volume,
+    so O(1)) and delete the trash on a background thread. Anything left over from an
+    earlier run that was interrupted is swept along with it.
+    """
+    ensure_dir(VSCODE_TRASH_DIR)
+    _forget_dirs(path)
+    try:
+        os.replace(path, os.path.join(VSCODE_TRASH_DIR, uuid.uuid4().hex))
+    except OSError:
+        shutil.rmtree(path, ignore_errors=True)
+        return
+    threading.Thread(target=_empty_trash, daemon=True).start()
+
+IN_MEMORY_ZIP_MAX = 64 * 1024 * 1024
+
+def fetch_zip(bucket: str, key: str, local_path: str, if_none_match: str | None = None):
+    """
+    Fetch a zip for extraction; returns (src, etag). Archives up to IN_MEMORY_ZIP_MAX come
+    back as bytes, so they are never written to disk and read back; larger ones go to
+    local_path and src is that path instead. Anything past the multipart threshold is
+    fetched as parallel ranged GETs (S3_TRANSFER_CONFIG) rather than one stream.
+    With if_none_match, src is None when S3 reports the object unchanged.
+    """
+    try:
+        obj = s3.get_object(Bucket=bucket, Key=key, **({"IfNoneMatch": if_none_match} if if_none_match else {}))
+    except botocore.exceptions.ClientError as ce:
+        if if_none_match and ce.response.get("Error", {}).get("Code") in ("304", "NotModified"):
+            return None, if_none_match
+        raise
+    size = obj["ContentLength"]
+    if size <= S3_TRANSFER_CONFIG.multipart_threshold:
+        with obj["Body"] as body:
+            return body.read(), obj["ETag"]
+    obj["Body"].close()
+    if size <= IN_MEMORY_ZIP_MAX:
+        buf = io.BytesIO()
+        s3.download_fileobj(bucket, key, buf, Config=S3_TRANSFER_CONFIG)
+        return buf.getvalue(), obj["ETag"]
+    s3.download_file(bucket, key, local_path, Config=S3_TRANSFER_CONFIG)
+    return local_path, obj["ETag"]
+
+# "<bucket>/<key> <etag>" of the last VSCode config zip applied successfully
+VSCODE_CONFIG_ETAG_FILE = os.path.join(VSCODE_BASE_DIR, "config.etag")
+
+def applied_vscode_config_etag(bucket: str, key: str):
+    try:
+        with open(VSCODE_CONFIG_ETAG_FILE, "r", encoding="utf-8") as f:
+            source, _, etag = f.read().strip().rpartition(" ")
+    except OSError:
+        return None
+    return etag if source == f"{bucket}/{key}" and etag else None
+
+def remember_vscode_config_etag(bucket: str, key: str, etag: str):
+    with open(VSCODE_CONFIG_ETAG_FILE, "w", encoding="utf-8") as f:
+        f.write(f"{bucket}/{key} {etag}")
+
+def open_zip(src) -> zipfile.ZipFile:
+    """src is a path or the bytes returned by fetch_zip (BytesIO over bytes doesn't copy)."""
+    return zipfile.ZipFile(io.BytesIO(src) if isinstance(src, bytes) else src, "r")
+
+UNZIP_WORKERS = min(8, os.cpu_count() or 1)
+UNZIP_PARALLEL_MIN_FILES = 64  # below this, thread start-up costs more than it saves
+
+def _extract_shard(src, shard):
+    # ZipFile handles aren't thread-safe, so every worker opens its own.
+    with open_zip(src) as zf:
+        for info, dst in shard:
+            with zf.open(info) as src, open(dst, "wb") as out:
+                shutil.copyfileobj(src, out, 1024 * 1024)
+
+def unzip(src, dest_dir: str):
+    """
+    Extract a zip (path or bytes, see open_zip) into dest_dir. Projects with many files
+    are extracted by a few threads over disjoint member slices (zlib and file writes
+    release the GIL).
+    """
     ensure_dir(dest_dir)
-    with zipfile.ZipFile(zip_path, "r") as zf:
-        zf.extractall(dest_dir)
+    with open_zip(src) as zf:
+        infos = zf.infolist()
+        if len(infos) < UNZIP_PARALLEL_MIN_FILES or UNZIP_WORKERS < 2:
+            zf.extractall(dest_dir)
+            return
+
+    dest_abs = os.path.abspath(dest_dir)
+    files, dirs = [], {dest_abs}
+    for info in infos:
+        dst = os.path.abspath(os.path.join(dest_abs, *info.filename.replace("\\", "/").split("/")))
+        if not dst.startswith(dest_abs + os.sep):
+            logger.warning(f"Skipping zip entry outside destination: {info.filename}")
+            continue
+        if info.is_dir():
+            dirs.add(dst)
+        else:
+            dirs.add(os.path.dirname(dst))
+            files.append((info, dst))
+
+    # One pass up front, so the workers never race each other in makedirs. (Not through
+    # ensure_dir: these are per-project trees, not worth remembering.)
+    for d in dirs:
+        os.makedirs(d, exist_ok=True)
+
+    shards = [files[i::UNZIP_WORKERS] for i in range(UNZIP_WORKERS)]
+    with ThreadPoolExecutor(max_workers=UNZIP_WORKERS) as pool:
+        for fut in [pool.submit(_extract_shard, src, shard) for shard in shards if shard]:
+            fut.result()
+
+_vscode_exe_cached = None
 
 def find_vscode_exe():
+    # Probed once; the install location doesn't move while the agent runs.
+    global _vscode_exe_cached
+    if _vscode_exe_cached:
+        return _vscode_exe_cached
     # Common install paths
     candidates = [
         r"C:\Program Files\Microsoft VS Code\Code.exe",
@@ -111,43 +349,62 @@ def find_vscode_exe():
     ]
     for p in candidates:
         if os.path.exists(p):
+            _vscode_exe_cached = p
             return p
-    return "code"  # fallback if code is on PATH
+    return "code"  # fallback if code is on PATH (not cached: VSCode may be installed later)
 
-def apply_vscode_user_config(cfg_dir: str):
+def _same_content(path: str, info: zipfile.ZipInfo) -> bool:
+    """True if path already holds this member (size, then CRC-32 from the zip directory)."""
+    try:
+        if os.path.getsize(path) != info.file_size:
+            return False
+        with open(path, "rb") as f:
+            return zlib.crc32(f.read()) == info.CRC
+    except OSError:
+        return False
+
+def apply_vscode_user_config(config_zip, ext_file: str):
     r"""
-    cfg_dir contains:
+    config_zip contains:
       - settings.json
       - keybindings.json
       - snippets\...
       - extensions.txt
-    Copy settings/keybindings/snippets into %APPDATA%\Code\User\
+    Extract settings/keybindings/snippets straight into %APPDATA%\Code\User\ (no staging
+    directory) and extensions.txt to ext_file.
     """
-    appdata = os.environ.get("APPDATA")
-    if not appdata:
-        # fallback typical Administrator roaming path
-        appdata = r"C:\Users\Administrator\AppData\Roaming"
-
-    user_dir = os.path.join(appdata, "Code", "User")
+    user_dir = VSCODE_USER_DIR
     ensure_dir(user_dir)
+    user_dir_abs = os.path.abspath(user_dir)
+
+    with open_zip(config_zip) as zf:
+        for info in zf.infolist():
+            name = info.filename.replace("\\", "/")
+            if info.is_dir():
+                continue
+            if name == "extensions.txt":
+                dst = ext_file
+            elif name in ("settings.json", "keybindings.json") or name.startswith("snippets/"):
+                dst = os.path.abspath(os.path.join(user_dir, *name.split("/")))
+                if not dst.startswith(user_dir_abs + os.sep):
+                    logger.warning(f"Skipping config entry outside user dir: {info.filename}")
+                    continue
+            else:
+                continue
 
-    # Copy settings.json, keybindings.json if present
-    for name in ["settings.json", "keybindings.json"]:
-        src = os.path.join(cfg_dir, name)
-        if os.path.exists(src):
-            dst = os.path.join(user_dir, name)
-            shutil.copy2(src, dst)
-            logger.info(f"Applied VSCode config: {name} -> {dst}")
+            if _same_content(dst, info):
+                continue  # already in place; don't rewrite it
 
-    # Copy snippets directory
-    snips_src = os.path.join(cfg_dir, "snippets")
-    if os.path.isdir(snips_src):
-        snips_dst = os.path.join(user_dir, "snippets")
-        shutil.copytree(snips_src, snips_dst, dirs_exist_ok=True)
-        logger.info(f"Applied VSCode snippets -> {snips_dst}")
+            ensure_dir(os.path.dirname(dst))
+            with zf.open(info) as src, open(dst, "wb") as out:
+                shutil.copyfileobj(src, out)
+            logger.info(f"Applied VSCode config: {name} -> {dst}")
 
     return user_dir
 
+# publisher.name, optionally pinned as publisher.name@version
+EXTENSION_ID_RE = re.compile(r"^[A-Za-z0-9][A-Za-z0-9-]*\.[A-Za-z0-9][A-Za-z0-9._-]*(@[A-Za-z0-9.+-]+)?$")
+
 def install_vscode_extensions_from_file(ext_file: str):
     """
     Best effort. Requires `code` CLI available (or Code.exe supports args via cmd /c).
@@ -157,56 +414,166 @@ def install_vscode_extensions_from_file(ext_file: str):
 
     try:
         with open(ext_file, "r", encoding="utf-8") as f:
-            exts = [line.strip() for line in f if line.strip()]
+            lines = [s for s in (ln.strip() for ln in f) if s and not s.startswith("#")]
     except Exception as e:
         logger.warning(f"Could not read extensions file: {e}")
         return
 
+    # A malformed entry would only cost a failing CLI run (or break the batched one).
+    exts = [ln for ln in lines if EXTENSION_ID_RE.match(ln)]
+    if len(exts) != len(lines):
+        logger.warning(f"Ignoring {len(lines) - len(exts)} malformed extension ids")
+
     if not exts:
         return
 
     code_exe = find_vscode_exe()
     logger.info(f"Installing {len(exts)} VSCode extensions (best effort) using: {code_exe}")
 
+    # The code CLI accepts repeated --install-extension flags: one CLI start-up for the
+    # whole list instead of one per extension.
+    batch_args = []
     for ext in exts:
+        batch_args += ["--install-extension", ext, "--force"]
+    try:
+        result = subprocess.run(
+            ["cmd.exe", "/c", "code", *batch_args],
+            capture_output=True, text=True, timeout=60 + 20 * len(exts)
+        )
+        if result.returncode == 0:
+            return
+        logger.warning(f"Batched extension install exited {result.returncode}; retrying one by one")
+    except Exception as e:
+        logger.warning(f"Batched extension install failed ({e}); retrying one by one")
+
+    with ThreadPoolExecutor(max_workers=min(4, len(exts))) as pool:
+        list(pool.map(_install_vscode_extension, exts, [code_exe] * len(exts)))
+
+def _install_vscode_extension(ext: str, code_exe: str):
+    try:
+        # Prefer code CLI if available
+        subprocess.run(
+            ["cmd.exe", "/c", "code", "--install-extension", ext, "--force"],
+            capture_output=True, text=True, timeout=45
+        )
+    except Exception:
+        # Fall back to running Code.exe directly (may or may not work)
         try:
-            # Prefer code CLI if available
             subprocess.run(
-                ["cmd.exe", "/c", "code", "--install-extension", ext, "--force"],
+                ["cmd.exe", "/c", code_exe, "--install-extension", ext, "--force"],
                 capture_output=True, text=True, timeout=45
             )
-        except Exception:
-            # Fall back to running Code.exe directly (may or may not work)
-            try:
-                subprocess.run(
-                    ["cmd.exe", "/c", code_exe, "--install-extension", ext, "--force"],
-                    capture_output=True, text=True, timeout=45
-                )
-            except Exception as e:
-                logger.warning(f"Extension install failed for {ext}: {e}")
+        except Exception as e:
+            logger.warning(f"Extension install failed for {ext}: {e}")
+
+# Regenerable, machine-specific trees: the VM's own venv, bytecode caches and npm installs.
+PRUNED_DIR_NAMES = frozenset({".venv", "__pycache__", "node_modules"})
+
+def iter_project_files(folder_path: str, skip_dirs=PRUNED_DIR_NAMES):
+    """
+    Yield os.DirEntry for every regular file under folder_path, not descending into
+    directories named in skip_dirs. os.scandir carries file type info from the directory
+    read, saving a stat per entry.
+    """
+    stack = [folder_path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name not in skip_dirs:
+                            stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        yield entry
+        except OSError as e:
+            logger.warning(f"Skipping unreadable directory: {e}")
+
+# Never where a workspace file lives, and often huge.
+WORKSPACE_SKIP_DIRS = PRUNED_DIR_NAMES | {".git", "dist", "build"}
+WORKSPACE_SEARCH_DEPTH = 2
 
 def pick_open_target(project_dir: str, kind: str):
     """
     If workspace zipped, find *.code-workspace inside extracted project.
     Else open the project folder.
+    Workspace files sit at (or just below) the root by convention, so the search is
+    breadth-first, WORKSPACE_SEARCH_DEPTH levels deep, and skips heavy directories.
     """
-    if kind == "workspace":
-        for root, _, files in os.walk(project_dir):
-            for fn in files:
-                if fn.lower().endswith(".code-workspace"):
-                    return os.path.join(root, fn)
+    if kind != "workspace":
+        return project_dir
+
+    level = [project_dir]
+    for _ in range(WORKSPACE_SEARCH_DEPTH + 1):
+        next_level = []
+        for folder in level:
+            try:
+                with os.scandir(folder) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.name not in WORKSPACE_SKIP_DIRS:
+                                next_level.append(entry.path)
+                        elif entry.name.lower().endswith(".code-workspace"):
+                            return entry.path
+            except OSError as e:
+                logger.warning(f"Skipping unreadable directory: {e}")
+        level = next_level
     return project_dir
 
+ACTIVE_SESSION_TTL = 5.0  # seconds; the session can change when VNC/RDP reconnects
+_active_session_cache = (None, 0.0)  # (session id, monotonic time it was read)
+
 def _get_active_session_id() -> str | None:
     """
-    Returns active session id (RDP/console) or None.
+    Returns active session id (RDP/console) or None. The session table is read at most once
+    per ACTIVE_SESSION_TTL; calls in between get the cached answer.
     """
+    global _active_session_cache
+    cached, at = _active_session_cache
+    if time.monotonic() - at < ACTIVE_SESSION_TTL:
+        return cached
+
+    try:
+        session_id = _wts_active_session_id()
+    except Exception as e:
+        logger.warning(f"WTSEnumerateSessionsW failed ({e}); falling back to qwinsta")
+        session_id = _qwinsta_active_session_id()
+    _active_session_cache = (session_id, time.monotonic())
+    return session_id
+
+class _WTS_SESSION_INFOW(ctypes.Structure):
+    _fields_ = [
+        ("SessionId", wintypes.DWORD),
+        ("pWinStationName", wintypes.LPWSTR),
+        ("State", ctypes.c_int),  # WTS_CONNECTSTATE_CLASS
+    ]
+
+_WTS_ACTIVE = 0
+
+def _wts_active_session_id() -> str | None:
+    """Active console/RDP session straight from the WTS API (no qwinsta process)."""
+    wtsapi = ctypes.windll.wtsapi32
+    info = ctypes.POINTER(_WTS_SESSION_INFOW)()
+    count = wintypes.DWORD()
+    if not wtsapi.WTSEnumerateSessionsW(None, 0, 1, ctypes.byref(info), ctypes.byref(count)):
+        raise ctypes.WinError()
+    try:
+        for i in range(count.value):
+            session = info[i]
+            station = (session.pWinStationName or "").lower()
+            if session.State == _WTS_ACTIVE and (station == "console" or station.startswith("rdp-tcp")):
+                return str(session.SessionId)
+    finally:
+        wtsapi.WTSFreeMemory(info)
+    return None
+
+def _qwinsta_active_session_id() -> str | None:
     try:
         out = subprocess.check_output(["qwinsta"], text=True, stderr=subprocess.STDOUT)
         for line in out.splitlines():
             parts = line.split()
             # Typical:  SESSIONNAME USERNAME ID STATE ...
-            if len(parts) >= 4 and parts[3].lower() == "active":
+            lowered = line.lower()
+            if len(parts) >= 4 and parts[3].lower() == "active" and ("console" in lowered or "rdp-tcp" in lowered):
                 # ID is usually the 3rd column
                 return parts[2]
     except Exception as e:
@@ -218,7 +585,7 @@ def launch_vscode(open_target: str, cwd: str):
     code_exe = find_vscode_exe()
     logger.info(f"Launching VSCode (interactive): {code_exe} target={open_target} cwd={cwd}")
 
-    schtasks = shutil.which("schtasks") or r"C:\Windows\System32\schtasks.exe"
+    schtasks = SCHTASKS_EXE
     task_name = "CloudRAM-LaunchVSCode"
 
     # Use cmd start to detach and allow spaces safely
@@ -260,9 +627,61 @@ def launch_vscode(open_target: str, cwd: str):
         logger.error(f"Failed to launch VSCode via schtasks: {e}")
         raise
 
+# ----------------------------
+# Process snapshot (shared by list_tasks / open-file checks)
+# ----------------------------
+LISTED_TASKS = frozenset({'notepad++.exe', 'chrome.exe', 'code.exe'})
+_proc_snapshot_lock = threading.Lock()
+_proc_snapshot_cache = {"ts": 0.0, "procs": []}
+
+def proc_snapshot(max_age: float = 0.5):
+    """
+    [(pid, name, name_lower, proc)] for every process. On Windows each process_iter opens
+    a handle per process, so back-to-back callers share one enumeration for max_age seconds.
+    `proc` is the psutil.Process the iteration yielded; use it rather than constructing a
+    new Process(pid), which would open the process again.
+    """
+    with _proc_snapshot_lock:
+        now = time.monotonic()
+        if now - _proc_snapshot_cache["ts"] > max_age:
+            procs = []
+            for proc in psutil.process_iter(attrs=['pid', 'name']):
+                name = proc.info['name'] or ""
+                procs.append((proc.info['pid'], name, name.lower(), proc))
+            _proc_snapshot_cache["procs"] = procs
+            _proc_snapshot_cache["ts"] = now
+        return _proc_snapshot_cache["procs"]
+
+def find_pid(image_name: str):
+    """
+    PID of the first process named image_name (case-insensitive), or None.
+    Fetches only the name and stops at the first match, instead of spawning tasklist.
+    """
+    target = image_name.lower()
+    for proc in psutil.process_iter(attrs=['name']):
+        if (proc.info['name'] or "").lower() == target:
+            return proc.pid
+    return None
+
+def wait_for_pid(image_name: str, timeout: float = 2.0, interval: float = 0.05):
+    """find_pid, polled every `interval` until the process shows up or `timeout` passes."""
+    deadline = time.monotonic() + timeout
+    while True:
+        pid = find_pid(image_name)
+        if pid or time.monotonic() >= deadline:
+            return pid
+        time.sleep(interval)
+
+_notepad_exe_cached = None
+
 def get_notepad_exe():
+    # Probed once per agent run (same as find_vscode_exe); misses are re-probed.
+    global _notepad_exe_cached
+    if _notepad_exe_cached:
+        return _notepad_exe_cached
     for path in NOTEPAD_PATHS:
         if os.path.exists(path):
+            _notepad_exe_cached = path
             return path
     return "notepad++.exe"
 
@@ -271,30 +690,29 @@ def get_notepad_exe():
 # ----------------------------
 @app.route("/")
 def home():
-    auth = require_api_key()
-    if auth:
-        return auth
     logger.info("Accessed home endpoint")
     return jsonify({"message": "Cloud RAM VM API is running!"})
 
+LIST_TASKS_MAX_AGE = 1.0  # the UI polls this; a second of staleness is invisible
+_tasks_cache = (None, [])  # (snapshot it was filtered from, task list); swapped atomically
+
 @app.route("/list_tasks", methods=["GET"])
 def list_tasks():
-    auth = require_api_key()
-    if auth:
-        return auth
-
-    target_tasks = ['notepad++.exe', 'chrome.exe', 'Code.exe']
-    task_list = []
-    for proc in psutil.process_iter(attrs=['pid', 'name']):
-        if proc.info['name'] in target_tasks:
-            task_list.append({"pid": proc.info['pid'], "name": proc.info['name']})
+    global _tasks_cache
+    procs = proc_snapshot(max_age=LIST_TASKS_MAX_AGE)
+    cached_procs, task_list = _tasks_cache
+    if cached_procs is not procs:
+        # Re-filter only when the snapshot itself was refreshed.
+        task_list = [
+            {"pid": pid, "name": name}
+            for pid, name, name_lower, _ in procs
+            if name_lower in LISTED_TASKS
+        ]
+        _tasks_cache = (procs, task_list)
     return jsonify({"tasks": task_list})
 
 @app.route("/terminate_task", methods=["POST"])
 def terminate_task():
-    auth = require_api_key()
-    if auth:
-        return auth
     data = request.get_json()
     pid = data.get("pid")
     if not pid:
@@ -303,6 +721,10 @@ def terminate_task():
     try:
         process = psutil.Process(pid)
         process.terminate()
+        # Wait on the handle instead of re-enumerating; hard-kill if it lingers.
+        _, alive = psutil.wait_procs([process], timeout=3)
+        for proc in alive:
+            proc.kill()
         running_tasks.pop(pid, None)
         logger.info(f"Task with PID {pid} terminated successfully")
         return jsonify({"message": f"Task with PID {pid} terminated successfully"})
@@ -312,9 +734,6 @@ def terminate_task():
 
 @app.route("/ram_usage", methods=["GET"])
 def ram_usage():
-    auth = require_api_key()
-    if auth:
-        return auth
     ram_info = psutil.virtual_memory()
     return jsonify({
         "total_ram": ram_info.total,
@@ -328,10 +747,6 @@ def ram_usage():
 # ----------------------------
 @app.route("/setup_vscode", methods=["POST"])
 def setup_vscode():
-    auth = require_api_key()
-    if auth:
-        return auth
-
     data = request.get_json(force=True) or {}
 
     pb = data.get("project_s3_bucket")
@@ -348,13 +763,18 @@ def setup_vscode():
     deps_meta_key = data.get("deps_s3_meta_key") or data.get("deps_meta_s3_key")  # accept both
 
 
+    # Backend endpoint to notify when the job finishes (push instead of polling). Only the
+    # configured one: the callback carries X-VM-API-KEY, so never a caller-supplied URL.
+    callback_url = BACKEND_CALLBACK_URL
+
     if not all([pb, pk, cb, ck]):
         return jsonify({"error": "Missing S3 bucket/key fields"}), 400
 
     job_id = str(uuid.uuid4())
+    prune_finished_jobs(vscode_jobs)
     vscode_jobs[job_id] = {
         "status": "running",
-        "message": "Starting VSCode setup...",
+        "message": "Queued VSCode setup...",
         "user_id": user_id,
         "project_name": project_name,
         "started_at": datetime.utcnow().isoformat() + "Z",
@@ -372,45 +792,81 @@ def setup_vscode():
             config_zip  = os.path.join(VSCODE_DOWNLOADS_DIR, "vscode_config.zip")
             deps_freeze = os.path.join(VSCODE_DOWNLOADS_DIR, "deps_freeze.txt")
 
-            logger.info(f"[{job_id}] Download project s3://{pb}/{pk} -> {project_zip}")
-            s3.download_file(pb, pk, project_zip)
-
-            logger.info(f"[{job_id}] Download config s3://{cb}/{ck} -> {config_zip}")
-            s3.download_file(cb, ck, config_zip)
-
-            if deps_bucket and deps_key:
-                logger.info(f"[{job_id}] Download deps s3://{deps_bucket}/{deps_key} -> {deps_freeze}")
-                s3.download_file(deps_bucket, deps_key, deps_freeze)
+            # The S3 client is thread-safe; fetch project/config/deps concurrently so
+            # wall time is bounded by the largest object rather than the sum. The zips
+            # usually stay in memory (fetch_zip); the freeze file is read by pip, so it
+            # always lands on disk.
+            vscode_jobs[job_id]["message"] = "Downloading project files..."
+            with ThreadPoolExecutor(max_workers=3) as pool:
+                logger.info(f"[{job_id}] Fetch s3://{pb}/{pk} and s3://{cb}/{ck}")
+                project_future = pool.submit(fetch_zip, pb, pk, project_zip)
+                # Unchanged config (same ETag as the last one applied) isn't even downloaded.
+                config_future = pool.submit(fetch_zip, cb, ck, config_zip, applied_vscode_config_etag(cb, ck))
+                futures = [project_future, config_future]
+                if deps_bucket and deps_key:
+                    logger.info(f"[{job_id}] Download s3://{deps_bucket}/{deps_key} -> {deps_freeze}")
+                    futures.append(pool.submit(
+                        s3.download_file, deps_bucket, deps_key, deps_freeze, Config=S3_TRANSFER_CONFIG
+                    ))
+                for fut in as_completed(futures):
+                    fut.result()  # surface the first failure
+                project_src, _ = project_future.result()
+                config_src, config_etag = config_future.result()
 
             # ✅ project path becomes: C:\CloudRAM\VSCode\projects\<project_name>
             dest_project_dir = os.path.join(VSCODE_PROJECTS_DIR, project_name)
+            old_venv = parked_venv = None
             if os.path.exists(dest_project_dir):
-                shutil.rmtree(dest_project_dir, ignore_errors=True)
-
-            vscode_jobs[job_id]["message"] = "Extracting project..."
-            unzip(project_zip, dest_project_dir)
-            project_root = normalize_extracted_project_root(dest_project_dir)
-            logger.info(f"[{job_id}] project_root resolved to: {project_root}")
-
-
-            vscode_jobs[job_id]["message"] = "Applying VSCode config..."
-            if os.path.exists(VSCODE_CFG_DIR):
-                shutil.rmtree(VSCODE_CFG_DIR, ignore_errors=True)
-            unzip(config_zip, VSCODE_CFG_DIR)
-            apply_vscode_user_config(VSCODE_CFG_DIR)
-
-            vscode_jobs[job_id]["message"] = "Installing extensions..."
-            ext_file = os.path.join(VSCODE_CFG_DIR, "extensions.txt")
-            install_vscode_extensions_from_file(ext_file)
-
-            # ✅ deps install (best effort)
-            if os.path.exists(deps_freeze):
-                vscode_jobs[job_id]["message"] = "Installing Python packages..."
-                dep_result = install_deps_from_freeze(project_root, deps_freeze)
-                write_vscode_python_interpreter(project_root)
-                logger.info(f"[{job_id}] dep_result: {dep_result}")
-            else:
-                logger.info(f"[{job_id}] deps_freeze not found, skipping deps install")
+                # Park the previous venv so an unchanged freeze file can reuse it.
+                old_venv = os.path.join(normalize_extracted_project_root(dest_project_dir), ".venv")
+                if os.path.isdir(old_venv):
+                    ensure_dir(VSCODE_PARKED_VENVS_DIR)
+                    parked_venv = os.path.join(VSCODE_PARKED_VENVS_DIR, job_id)
+                    try:
+                        os.replace(old_venv, parked_venv)
+                    except OSError:
+                        parked_venv = None
+                discard_dir(dest_project_dir)
+
+            ext_file = os.path.join(VSCODE_DOWNLOADS_DIR, "extensions.txt")
+            if os.path.exists(ext_file):
+                os.remove(ext_file)  # don't reinstall a previous job's list
+
+            # Independent steps run side by side: the project extract (zlib releases the
+            # GIL) with the config apply, then extension installs with the pip install.
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                vscode_jobs[job_id]["message"] = "Extracting project and applying VSCode config..."
+                if config_src is not None:
+                    cfg_future = pool.submit(apply_vscode_user_config, config_src, ext_file)
+                else:
+                    logger.info(f"[{job_id}] VSCode config unchanged since last setup; not re-applying")
+                    cfg_future = None
+                unzip(project_src, dest_project_dir)
+                project_root = normalize_extracted_project_root(dest_project_dir)
+                logger.info(f"[{job_id}] project_root resolved to: {project_root}")
+                if parked_venv:
+                    # Only back in the exact same place: venv launchers embed their path.
+                    new_venv = os.path.join(project_root, ".venv")
+                    if new_venv == old_venv and not os.path.exists(new_venv):
+                        os.replace(parked_venv, new_venv)
+                    else:
+                        discard_dir(parked_venv)
+                if cfg_future is not None:
+                    cfg_future.result()
+                    remember_vscode_config_etag(cb, ck, config_etag)
+
+                ext_future = pool.submit(install_vscode_extensions_from_file, ext_file)
+
+                # ✅ deps install (best effort)
+                if os.path.exists(deps_freeze):
+                    vscode_jobs[job_id]["message"] = "Installing extensions and Python packages..."
+                    dep_result = install_deps_from_freeze(project_root, deps_freeze)
+                    write_vscode_python_interpreter(project_root)
+                    logger.info(f"[{job_id}] dep_result: {dep_result}")
+                else:
+                    vscode_jobs[job_id]["message"] = "Installing extensions..."
+                    logger.info(f"[{job_id}] deps_freeze not found, skipping deps install")
+                ext_future.result()
 
             open_target = pick_open_target(project_root, kind)
 
@@ -427,11 +883,60 @@ def setup_vscode():
             vscode_jobs[job_id]["message"] = str(e)
             vscode_jobs[job_id]["finished_at"] = datetime.utcnow().isoformat() + "Z"
 
-    threading.Thread(target=worker, daemon=True).start()
+        notify_setup_callback(callback_url, job_id)
+
+    vscode_setup_pool.submit(worker)
 
     # ✅ Return immediately so local side doesn't timeout
     return jsonify({"ok": True, "job_id": job_id})
     
+def notify_setup_callback(callback_url: str | None, job_id: str):
+    """
+    Best effort: POST the terminal job status to the backend so it can push it to clients.
+    """
+    if not callback_url:
+        return
+    job = vscode_jobs.get(job_id, {})
+    payload = {
+        "job_id": job_id,
+        "status": job.get("status"),
+        "message": job.get("message"),
+        "user_id": job.get("user_id"),
+        "finished_at": job.get("finished_at"),
+    }
+    headers = {"X-VM-API-KEY": VM_API_KEY} if VM_API_KEY else {}
+    try:
+        http.post(callback_url, json=payload, headers=headers, timeout=10)
+    except Exception as e:
+        logger.warning(f"[{job_id}] setup callback to {callback_url} failed: {e}")
+
+def create_venv(venv_dir: str):
+    """
+    Build the venv in-process with the agent's own interpreter (the system python it
+    was started with) instead of spawning `python -m venv`; only ensurepip still runs
+    as a child process.
+    """
+    venv.EnvBuilder(with_pip=True).create(venv_dir)
+
+PIP_CACHE_DIR = os.getenv("PIP_CACHE_DIR", r"C:\CloudRAM\pip-cache")
+PIP_MIN_VERSION = (23, 0)
+PIP_FALLBACK_CHUNK = 20
+
+def venv_pip_version(venv_dir: str) -> tuple:
+    """pip's version from its dist-info folder name (no interpreter start); (0,) if unknown."""
+    site_packages = os.path.join(venv_dir, "Lib", "site-packages")
+    try:
+        with os.scandir(site_packages) as it:
+            for entry in it:
+                if entry.name.startswith("pip-") and entry.name.endswith(".dist-info"):
+                    version = entry.name[len("pip-"):-len(".dist-info")]
+                    return tuple(int(p) for p in version.split(".")[:2] if p.isdigit())
+    except OSError:
+        pass
+    return (0,)
+
+DEPS_STAMP_NAME = ".cloudram_deps"  # blake2b of the freeze file a venv was fully installed from
+
 def install_deps_from_freeze(project_dir: str, freeze_file: str):
     """
     Creates/uses project_dir\\.venv and installs dependencies from a pip-freeze style file.
@@ -451,33 +956,51 @@ def install_deps_from_freeze(project_dir: str, freeze_file: str):
     venv_dir = os.path.join(project_dir, ".venv")
     venv_py = os.path.join(venv_dir, "Scripts", "python.exe")
 
-    base_py = "python"  # system python
-
     logger.info(f"Installing deps from freeze: {freeze_file}")
     logger.info(f"Project dir: {project_dir}")
 
     # 1) Create venv if missing
     if not os.path.exists(venv_py):
         logger.info(f"Creating venv at: {venv_dir}")
-        subprocess.check_call([base_py, "-m", "venv", venv_dir])
+        create_venv(venv_dir)
 
     # 2) If venv dir exists but python.exe missing/broken, recreate
     if os.path.exists(venv_dir) and not os.path.exists(venv_py):
         logger.warning("Found .venv dir but missing python.exe; recreating venv...")
         shutil.rmtree(venv_dir, ignore_errors=True)
-        subprocess.check_call([base_py, "-m", "venv", venv_dir])
+        create_venv(venv_dir)
 
     if not os.path.exists(venv_py):
         raise RuntimeError("venv python was not created properly (missing .venv\\Scripts\\python.exe)")
 
-    # 3) Upgrade pip
-    logger.info("Upgrading pip inside venv...")
-    subprocess.check_call([venv_py, "-m", "pip", "install", "--upgrade", "pip"])
+    # A venv carried over from the previous setup of this project that was built from
+    # the same freeze file needs no pip run at all.
+    with open(freeze_file, "rb") as f:
+        deps_digest = hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+    stamp_path = os.path.join(venv_dir, DEPS_STAMP_NAME)
+    try:
+        with open(stamp_path, "r", encoding="ascii") as f:
+            if f.read().strip() == deps_digest:
+                logger.info("Freeze file unchanged since this venv was built; skipping pip")
+                return {"ok": True, "mode": "cached", "venv": venv_dir}
+    except OSError:
+        pass
+
+    # Persistent wheel/http cache shared by every project venv on this VM.
+    env = {**os.environ, "PIP_CACHE_DIR": PIP_CACHE_DIR, "PIP_DISABLE_PIP_VERSION_CHECK": "1"}
+    pip_install = [venv_py, "-m", "pip", "install", "--prefer-binary"]
+
+    # 3) Upgrade pip (only when the venv's bundled pip is older than PIP_MIN_VERSION)
+    if venv_pip_version(venv_dir) < PIP_MIN_VERSION:
+        logger.info("Upgrading pip inside venv...")
+        subprocess.check_call([venv_py, "-m", "pip", "install", "--upgrade", "pip"], env=env)
 
     # 4) Bulk install
     logger.info("Installing deps from freeze file (bulk)...")
     try:
-        subprocess.check_call([venv_py, "-m", "pip", "install", "-r", freeze_file], cwd=project_dir)
+        subprocess.check_call([*pip_install, "-r", freeze_file], cwd=project_dir, env=env)
+        with open(stamp_path, "w", encoding="ascii") as f:
+            f.write(deps_digest)
         return {
             "ok": True,
             "mode": "bulk",
@@ -486,24 +1009,36 @@ def install_deps_from_freeze(project_dir: str, freeze_file: str):
     except Exception as bulk_err:
         logger.warning(f"Bulk install failed, falling back to line-by-line. Error: {bulk_err}")
 
-    # 5) Line-by-line fallback
+    # 5) Line-by-line fallback: chunks of PIP_FALLBACK_CHUNK per pip run, and only a
+    #    chunk that fails is retried one package at a time to find the bad lines.
     failed = []
     installed = 0
 
     with open(freeze_file, "r", encoding="utf-8", errors="ignore") as f:
         lines = [ln.strip() for ln in f.readlines() if ln.strip() and not ln.strip().startswith("#")]
 
+    pkgs = []
     for ln in lines:
         # Skip machine-specific / path based installs
         if ln.startswith("-e ") or " @" in ln:
             failed.append({"pkg": ln, "error": "Skipped editable/path-based requirement"})
             continue
+        pkgs.append(ln)
 
+    for i in range(0, len(pkgs), PIP_FALLBACK_CHUNK):
+        chunk = pkgs[i:i + PIP_FALLBACK_CHUNK]
         try:
-            subprocess.check_call([venv_py, "-m", "pip", "install", ln], cwd=project_dir)
-            installed += 1
-        except Exception as e:
-            failed.append({"pkg": ln, "error": str(e)})
+            subprocess.check_call([*pip_install, *chunk], cwd=project_dir, env=env)
+            installed += len(chunk)
+            continue
+        except Exception:
+            pass
+        for ln in chunk:
+            try:
+                subprocess.check_call([*pip_install, ln], cwd=project_dir, env=env)
+                installed += 1
+            except Exception as e:
+                failed.append({"pkg": ln, "error": str(e)})
 
     return {
         "ok": installed > 0,
@@ -519,9 +1054,6 @@ def install_deps_from_freeze(project_dir: str, freeze_file: str):
 # ----------------------------
 @app.route("/run_task", methods=["POST"])
 def run_task():
-    auth = require_api_key()
-    if auth:
-        return auth
     try:
         logger.info("/run_task endpoint called")
         data = request.get_json()
@@ -534,8 +1066,8 @@ def run_task():
             return jsonify({"error": f"Unsupported task: {task}"}), 400
 
         # Ensure directories exist
-        os.makedirs(SYNCED_DIR, exist_ok=True)
-        os.makedirs("C:\\CloudRAM", exist_ok=True)
+        ensure_dir(SYNCED_DIR)
+        ensure_dir("C:\\CloudRAM")
 
         # Sync files from S3
         try:
@@ -543,12 +1075,13 @@ def run_task():
         except Exception as sync_error:
             logger.error(f"Sync error: {sync_error}")
 
-        # Gather file paths
-        file_paths = [
-            os.path.join(SYNCED_DIR, f)
-            for f in os.listdir(SYNCED_DIR)
-            if os.path.isfile(os.path.join(SYNCED_DIR, f)) and f.endswith(('.txt', '.cpp', '.py', '.html'))
-        ]
+        # Gather file paths (scandir entries carry name/path/type, no per-file join or stat)
+        with os.scandir(SYNCED_DIR) as it:
+            file_paths = [
+                entry.path
+                for entry in it
+                if is_synced_name(entry.name) and entry.is_file()
+            ]
 
         if not file_paths:
             logger.info("No files found to open")
@@ -560,32 +1093,18 @@ def run_task():
             logger.error(f"Notepad++ executable not found at {notepad_exe}")
             return jsonify({"error": "Notepad++ executable not found"}), 500
 
-        # Log current session info for debugging
+        # Log current session info for debugging (kernel32 call, no wmic process)
         try:
-            session_info = subprocess.run(
-                ["wmic", "process", "where", f"ProcessID={os.getpid()}", "get", "SessionId"],
-                capture_output=True, text=True
-            )
-            logger.info(f"Flask app running in session: {session_info.stdout}")
+            own_session = wintypes.DWORD()
+            if not ctypes.windll.kernel32.ProcessIdToSessionId(os.getpid(), ctypes.byref(own_session)):
+                raise ctypes.WinError()
+            logger.info(f"Flask app running in session: {own_session.value}")
         except Exception as e:
             logger.error(f"Failed to get session info: {e}")
 
         # Get the active session ID (VNC session)
-        try:
-            session_check = subprocess.run(
-                ["qwinsta"], capture_output=True, text=True
-            )
-            logger.info(f"Active sessions: {session_check.stdout}")
-            active_session_id = None
-            for line in session_check.stdout.splitlines():
-                parts = line.split()
-                if len(parts) >= 4 and parts[3] == "Active" and ("console" in line.lower() or "rdp-tcp" in line.lower()):
-                    active_session_id = parts[2]  # Session ID is the third column
-                    break
-            logger.info(f"Detected active session ID: {active_session_id}")
-        except Exception as e:
-            logger.error(f"Failed to get active session: {e}")
-            active_session_id = None
+        active_session_id = _get_active_session_id()
+        logger.info(f"Detected active session ID: {active_session_id}")
 
         # Use schtasks to launch Notepad++ in the active session
         task_name = "LaunchNotepad"
@@ -599,19 +1118,11 @@ def run_task():
         logger.info(f"Preparing to launch Notepad++ with schtasks command: {cmd}")
 
         try:
-            # Delete existing task if it exists
-            delete_result = subprocess.run(
-                ["schtasks", "/delete", "/tn", task_name, "/f"],
-                capture_output=True, text=True
-            )
-            logger.info(f"schtasks delete output: {delete_result.stdout}")
-            if delete_result.stderr:
-                logger.error(f"schtasks delete error: {delete_result.stderr}")
-
-            # Create a scheduled task to run immediately under the Administrator user
+            # Create (or, with /f, replace) a scheduled task to run immediately under the
+            # Administrator user - no separate /delete or /query process needed.
             create_task_cmd = [
-                "schtasks", "/create", "/tn", task_name, "/tr", cmd,
-                "/sc", "once", "/st", "00:00", "/ru", "Administrator", "/it"
+                SCHTASKS_EXE, "/create", "/tn", task_name, "/tr", cmd,
+                "/sc", "once", "/st", "00:00", "/ru", "Administrator", "/it", "/f"
             ]
             create_result = subprocess.run(
                 create_task_cmd, capture_output=True, text=True
@@ -620,17 +1131,8 @@ def run_task():
             if create_result.stderr:
                 logger.error(f"schtasks create error: {create_result.stderr}")
 
-            # Check if task was created
-            query_task = subprocess.run(
-                ["schtasks", "/query", "/tn", task_name],
-                capture_output=True, text=True
-            )
-            logger.info(f"schtasks query output: {query_task.stdout}")
-            if query_task.stderr:
-                logger.error(f"schtasks query error: {query_task.stderr}")
-
             # Run the task immediately
-            run_task_cmd = ["schtasks", "/run", "/tn", task_name]
+            run_task_cmd = [SCHTASKS_EXE, "/run", "/tn", task_name]
             run_result = subprocess.run(
                 run_task_cmd, capture_output=True, text=True
             )
@@ -638,24 +1140,12 @@ def run_task():
             if run_result.stderr:
                 logger.error(f"schtasks run error: {run_result.stderr}")
 
-            # Check if Notepad++ is running
-            time.sleep(2)  # Give it a moment to start
-            task_check = subprocess.run(
-                ["tasklist", "/FI", "IMAGENAME eq notepad++.exe", "/V"],
-                capture_output=True, text=True
-            )
-            logger.info(f"Tasklist output for Notepad++: {task_check.stdout}")
-
-            # Extract PID if Notepad++ is running
-            pid = None
-            for line in task_check.stdout.splitlines():
-                if "notepad++.exe" in line.lower():
-                    parts = line.split()
-                    pid = parts[1]  # PID is the second column
-                    break
+            # Check if Notepad++ is running (returns as soon as it appears)
+            pid = wait_for_pid("notepad++.exe")
+            logger.info(f"Notepad++ pid: {pid}")
 
             if not pid:
-                logger.warning("Notepad++ not found in tasklist, trying notepad.exe as fallback")
+                logger.warning("Notepad++ not running, trying notepad.exe as fallback")
                 # OLD (remove)
                 # cmd_fallback = f'"notepad.exe" {" ".join([f"\\"{path}\\"" for path in file_paths])}'
 
@@ -664,8 +1154,8 @@ def run_task():
                 cmd_fallback = f'"notepad.exe" {quoted_files}'
 
                 create_task_cmd = [
-                    "schtasks", "/create", "/tn", task_name, "/tr", cmd_fallback,
-                    "/sc", "once", "/st", "00:00", "/ru", "Administrator", "/it"
+                    SCHTASKS_EXE, "/create", "/tn", task_name, "/tr", cmd_fallback,
+                    "/sc", "once", "/st", "00:00", "/ru", "Administrator", "/it", "/f"
                 ]
                 create_result = subprocess.run(
                     create_task_cmd, capture_output=True, text=True
@@ -675,25 +1165,15 @@ def run_task():
                     logger.error(f"schtasks create (fallback) error: {create_result.stderr}")
 
                 run_result = subprocess.run(
-                    ["schtasks", "/run", "/tn", task_name],
+                    [SCHTASKS_EXE, "/run", "/tn", task_name],
                     capture_output=True, text=True
                 )
                 logger.info(f"schtasks run (fallback) output: {run_result.stdout}")
                 if run_result.stderr:
                     logger.error(f"schtasks run (fallback) error: {run_result.stderr}")
 
-                time.sleep(2)
-                task_check = subprocess.run(
-                    ["tasklist", "/FI", "IMAGENAME eq notepad.exe", "/V"],
-                    capture_output=True, text=True
-                )
-                logger.info(f"Tasklist output for notepad.exe: {task_check.stdout}")
-
-                for line in task_check.stdout.splitlines():
-                    if "notepad.exe" in line.lower():
-                        parts = line.split()
-                        pid = parts[1]
-                        break
+                pid = wait_for_pid("notepad.exe")
+                logger.info(f"notepad.exe pid: {pid}")
 
             opened_files = file_paths
             if pid:
@@ -721,10 +1201,6 @@ def run_task():
 # ----------------------------
 @app.route("/sync_notepad_files", methods=["POST"])
 def sync_notepad_files_endpoint():
-    auth = require_api_key()
-    if auth:
-        return auth
-
     data = request.get_json()
     specific_file = data.get("file")
 
@@ -739,14 +1215,76 @@ def sync_notepad_files_endpoint():
 
     return jsonify({"message": "Notepad++ files synced with S3"})
 
+@app.route("/sync_notepad_files_batch", methods=["POST"])
+def sync_notepad_files_batch_endpoint():
+    """
+    One call for a whole batch of uploaded files (instead of one /sync_notepad_files
+    per file): downloads them concurrently, then refreshes Notepad++ once.
+    """
+    data = request.get_json(force=True) or {}
+    # Keys are flat filenames (see upload_to_s3); reject anything path-like.
+    files = [
+        f for f in (data.get("files") or [])
+        if isinstance(f, str) and f and os.path.basename(f) == f and f not in (".", "..")
+    ]
+    if not files:
+        return jsonify({"error": "files required"}), 400
+
+    logger.info(f"Syncing batch of {len(files)} files")
+    ensure_dir(SYNCED_DIR)
+    # All downloads in flight at once on the shared transfer pool; joined before the refresh.
+    transfers = [
+        (name, os.path.join(SYNCED_DIR, name))
+        for name in files
+    ]
+    futures = [(name, path, transfer_manager.download(BUCKET_NAME, name, path)) for name, path in transfers]
+    for name, local_path, future in futures:
+        try:
+            future.result()
+            remember_synced(local_path)
+            logger.info(f"Downloaded {name}")
+        except Exception as e:
+            logger.error(f"Error downloading {name}: {e}")
+    refresh_open_files_in_notepad()
+
+    return jsonify({"message": f"Synced {len(files)} Notepad++ files with S3", "file_count": len(files)})
+
 def sync_specific_file(filename):
     """Sync a specific file from S3"""
-    os.makedirs(SYNCED_DIR, exist_ok=True)
+    ensure_dir(SYNCED_DIR)
     local_path = os.path.join(SYNCED_DIR, filename)
 
+    try:
+        st = os.stat(local_path)
+    except OSError:
+        st = None
+
     try:
         logger.info(f"Downloading {filename} to {local_path}")
-        s3.download_file(BUCKET_NAME, filename, local_path)
+        etag = None
+        if st is None:
+            s3.download_file(BUCKET_NAME, filename, local_path)
+        else:
+            # Conditional GET: S3 answers 304 without a body when our copy is current.
+            # Prefer the ETag we last synced (exact, and right for our own uploads too).
+            known_etag = synced_etag(local_path, (st.st_mtime_ns, st.st_size))
+            condition = (
+                {"IfNoneMatch": known_etag} if known_etag
+                else {"IfModifiedSince": datetime.fromtimestamp(st.st_mtime, tz=timezone.utc)}
+            )
+            try:
+                obj = s3.get_object(Bucket=BUCKET_NAME, Key=filename, **condition)
+            except botocore.exceptions.ClientError as ce:
+                if ce.response.get("Error", {}).get("Code") in ("304", "NotModified"):
+                    logger.info(f"{filename} not modified in S3; keeping local copy")
+                    return
+                raise
+            tmp_path = local_path + ".part"
+            with obj["Body"] as body, open(tmp_path, "wb") as out:
+                shutil.copyfileobj(body, out, 1024 * 1024)
+            os.replace(tmp_path, local_path)
+            etag = obj["ETag"]
+        remember_synced(local_path, etag=etag)
         logger.info(f"Downloaded {filename}")
 
         # If this file is open in Notepad++, refresh it
@@ -755,26 +1293,149 @@ def sync_specific_file(filename):
     except Exception as e:
         logger.error(f"Error downloading {filename}: {e}")
 
+def is_synced_name(path: str) -> bool:
+    """True for the file types mirrored between S3 and SYNCED_DIR (case-insensitive)."""
+    return os.path.splitext(path)[1].lower() in SYNCED_EXTS
+
+# local_path -> (st_mtime_ns, st_size, etag or None) as of the agent's last download/upload
+# of it. Persisted to SYNC_STATE_FILE so a restarted agent still knows what is already in S3.
+_synced_state = {}
+_synced_state_lock = threading.Lock()
+_sync_state_save_timer = None
+
+def load_sync_state():
+    try:
+        with open(SYNC_STATE_FILE, "r", encoding="utf-8") as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return
+    with _synced_state_lock:
+        # Older manifests stored only (mtime_ns, size); their etag is unknown.
+        _synced_state.update({path: (*entry[:2], entry[2] if len(entry) > 2 else None) for path, entry in saved.items()})
+    logger.info(f"Loaded sync state for {len(saved)} files")
+
+def _save_sync_state():
+    global _sync_state_save_timer
+    with _synced_state_lock:
+        _sync_state_save_timer = None
+        snapshot = dict(_synced_state)
+    tmp = SYNC_STATE_FILE + ".tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp, SYNC_STATE_FILE)  # atomic: never leaves a half-written manifest
+    except OSError as e:
+        logger.error(f"Could not save sync state: {e}")
+
+def _schedule_sync_state_save():
+    # Caller holds _synced_state_lock. A burst of syncs produces one write.
+    global _sync_state_save_timer
+    if _sync_state_save_timer is None:
+        _sync_state_save_timer = threading.Timer(1.0, _save_sync_state)
+        _sync_state_save_timer.daemon = True
+        _sync_state_save_timer.start()
+
+def _stat_key(path: str):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def remember_synced(path: str, key=None, etag=None):
+    """
+    Record path as in sync with S3 (and with which object ETag, when known); pass `key`
+    when the caller already has the stat.
+    """
+    if key is None:
+        key = _stat_key(path)
+    with _synced_state_lock:
+        if key:
+            _synced_state[path] = (*key, etag)
+        else:
+            _synced_state.pop(path, None)
+        _schedule_sync_state_save()
+
+def is_synced(path: str, key=None) -> bool:
+    if key is None:
+        key = _stat_key(path)
+    with _synced_state_lock:
+        entry = _synced_state.get(path)
+    return key is not None and entry is not None and entry[:2] == key
+
+def synced_etag(path: str, key):
+    """ETag recorded for path, provided the file hasn't changed since (else None)."""
+    with _synced_state_lock:
+        entry = _synced_state.get(path)
+    return entry[2] if key is not None and entry is not None and entry[:2] == key else None
+
+def matching_synced_etag(path: str, size: int):
+    """
+    ETag of the object last synced for path if the file's bytes still equal it, even
+    though its stat changed (editors re-save identical content or only touch the mtime).
+    Single-part S3 ETags are the content MD5, so one local hash settles it. None if the
+    content differs or can't be compared.
+    """
+    with _synced_state_lock:
+        entry = _synced_state.get(path)
+    etag = entry[2] if entry is not None else None
+    if not etag or "-" in etag or entry[1] != size or size > S3_TRANSFER_CONFIG.multipart_threshold:
+        return None  # unknown, multipart-style or resized: not comparable without a download
+    digest = hashlib.md5(usedforsecurity=False)
+    try:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+    except OSError:
+        return None
+    return etag if digest.hexdigest() == etag.strip('"') else None
+
+def is_local_copy_current(local_path: str, obj: dict) -> bool:
+    """
+    True if local_path already matches the listed object: either it is untouched since we
+    synced exactly this ETag, or it has the object's size and is at least as new.
+    """
+    try:
+        st = os.stat(local_path)
+    except OSError:
+        return False
+    if synced_etag(local_path, (st.st_mtime_ns, st.st_size)) == obj['ETag']:
+        return True  # also covers our own uploads, whose S3 LastModified is after the local mtime
+    return st.st_size == obj['Size'] and st.st_mtime >= obj['LastModified'].timestamp()
+
 def sync_notepad_files():
-    os.makedirs(SYNCED_DIR, exist_ok=True)
+    ensure_dir(SYNCED_DIR)
     logger.info(f"Syncing from S3 bucket: {BUCKET_NAME}")
 
     try:
-        response = s3.list_objects_v2(Bucket=BUCKET_NAME)
-        objects = response.get('Contents', [])
+        # Paginate (a single call stops at 1000 keys); each listing entry already carries
+        # LastModified/Size, so no per-key HEAD is needed to decide what to fetch.
+        paginator = s3.get_paginator('list_objects_v2')
+        objects = [
+            obj
+            for page in paginator.paginate(Bucket=BUCKET_NAME, PaginationConfig={'PageSize': 1000})
+            for obj in page.get('Contents', [])
+        ]
 
         if not objects:
             logger.info("No files found in S3 bucket")
             return
 
+        transfers = []
         for obj in objects:
             s3_key = obj['Key']
             filename = os.path.basename(s3_key)
             local_path = os.path.join(SYNCED_DIR, filename)
+            if is_local_copy_current(local_path, obj):
+                continue
+            logger.info(f"Downloading {s3_key} to {local_path}")
+            future = transfer_manager.download(BUCKET_NAME, s3_key, local_path)
+            transfers.append((s3_key, filename, local_path, obj['ETag'], future))
 
+        for s3_key, filename, local_path, etag, future in transfers:
             try:
-                logger.info(f"Downloading {s3_key} to {local_path}")
-                s3.download_file(BUCKET_NAME, s3_key, local_path)
+                future.result()
+                remember_synced(local_path, etag=etag)
                 logger.info(f"Downloaded {filename}")
             except Exception as e:
                 logger.error(f"Error downloading {s3_key}: {e}")
@@ -784,16 +1445,51 @@ def sync_notepad_files():
     except Exception as e:
         logger.error(f"General sync error: {e}")
 
+# Uploads of the same path run one at a time (the watcher's leading upload and its
+# trailing one can otherwise overlap and land out of order). Striped by path so the
+# lock table stays fixed-size; each upload stats/reads the file only once it holds the
+# lock, so whichever runs last ships the newest content.
+_UPLOAD_LOCK_STRIPES = 64
+_upload_locks = [threading.Lock() for _ in range(_UPLOAD_LOCK_STRIPES)]
+
 def upload_to_s3(file_path):
     """Upload modified file to S3 bucket"""
-    if not os.path.isfile(file_path):
+    with _upload_locks[hash(os.path.normcase(file_path)) % _UPLOAD_LOCK_STRIPES]:
+        _upload_to_s3(file_path)
+
+def _upload_to_s3(file_path):
+    # One stat answers both "is it a file" and "has it changed since we synced it".
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        st = None
+    if st is None or not stat.S_ISREG(st.st_mode):
         logger.error(f"Cannot upload non-existent file: {file_path}")
         return
 
+    key = (st.st_mtime_ns, st.st_size)
+    if is_synced(file_path, key):
+        # Unchanged since we last downloaded/uploaded it (e.g. the watcher seeing our own
+        # sync write) - no HEAD or PUT needed.
+        logger.info(f"Skipping upload of unchanged file: {file_path}")
+        return
+    etag = matching_synced_etag(file_path, st.st_size)
+    if etag is not None:
+        remember_synced(file_path, key, etag)
+        logger.info(f"Skipping upload of identical content: {file_path}")
+        return
+
     try:
         filename = os.path.basename(file_path)
         logger.info(f"Uploading {filename} to S3")
-        s3.upload_file(file_path, BUCKET_NAME, filename)
+        transfer_manager.upload(file_path, BUCKET_NAME, filename).result()
+        # The upload future carries no ETag; one HEAD records it so the next listing sees
+        # this object as ours rather than as newer than the local file.
+        try:
+            etag = s3.head_object(Bucket=BUCKET_NAME, Key=filename)['ETag']
+        except Exception:
+            etag = None
+        remember_synced(file_path, key, etag)
         logger.info(f"Uploaded {filename} to S3")
 
     except Exception as e:
@@ -801,9 +1497,6 @@ def upload_to_s3(file_path):
 
 @app.route("/upload_modified_file", methods=["POST"])
 def upload_modified_file():
-    auth = require_api_key()
-    if auth:
-        return auth
     data = request.get_json()
     file_path = data.get("file_path")
 
@@ -822,32 +1515,61 @@ def upload_modified_file():
         logger.error(f"Error uploading file: {e}")
         return jsonify({"error": str(e)}), 500
 
+OPEN_FILES_MAX_AGE = 2.0
+
+# normcase(path) -> path for the synced files. Filled by one listdir on first use, then
+# kept current by NotepadSyncHandler events instead of re-listing SYNCED_DIR per check.
+_synced_set = None
+_synced_set_lock = threading.Lock()
+_open_files_cache = (0.0, [])  # (monotonic timestamp, result)
+
+def _synced_files() -> dict:
+    global _synced_set
+    with _synced_set_lock:
+        if _synced_set is None:
+            if not os.path.isdir(SYNCED_DIR):
+                return {}
+            _synced_set = {
+                os.path.normcase(path): path
+                for path in (os.path.join(SYNCED_DIR, f) for f in os.listdir(SYNCED_DIR))
+                if is_synced_name(path)
+            }
+        return dict(_synced_set)
+
+def track_synced_file(path: str, present: bool = True):
+    with _synced_set_lock:
+        if _synced_set is None:
+            return  # not listed yet; the first check will pick it up
+        if present:
+            _synced_set[os.path.normcase(path)] = path
+        else:
+            _synced_set.pop(os.path.normcase(path), None)
+
 def check_for_open_notepad_files():
     """Check if any notepad processes have the synced files open"""
-    if not os.path.exists(SYNCED_DIR):
-        return []
-
-    synced_files = [
-        os.path.join(SYNCED_DIR, f)
-        for f in os.listdir(SYNCED_DIR)
-        if f.endswith(('.txt', '.cpp', '.py', '.html'))
-    ]
+    global _open_files_cache
+    checked_at, cached = _open_files_cache
+    if time.monotonic() - checked_at < OPEN_FILES_MAX_AGE:
+        return list(cached)
 
+    synced_files = _synced_files()
     if not synced_files:
+        # Skip the open_files() handle enumeration entirely
         return []
 
     open_files = []
-    for proc in psutil.process_iter(['pid', 'name']):
-        if proc.info['name'] == 'notepad++.exe':
+    for _, _, name_lower, proc in proc_snapshot():
+        if name_lower == 'notepad++.exe':
             try:
-                p = psutil.Process(proc.info['pid'])
-                for file in p.open_files():
-                    if file.path in synced_files:
-                        open_files.append(file.path)
+                for file in proc.open_files():
+                    tracked = synced_files.get(os.path.normcase(file.path))
+                    if tracked is not None:
+                        open_files.append(tracked)
             except (psutil.AccessDenied, psutil.NoSuchProcess):
                 pass
 
-    return open_files
+    _open_files_cache = (time.monotonic(), open_files)
+    return list(open_files)
 
 def refresh_open_files_in_notepad():
     """Alert Notepad++ to reload files that may have changed"""
@@ -860,50 +1582,314 @@ def refresh_open_files_in_notepad():
     # Notepad++ auto-detects file changes; ensure files are synced.
 
 class NotepadSyncHandler(FileSystemEventHandler):
-    def on_modified(self, event):
+    """
+    Uploads synced Notepad++ files to S3 when they change on the VM.
+    Events for directories and other file types are dropped in dispatch(). The first
+    event for a path uploads right away; further events inside the next DEBOUNCE_SECONDS
+    (editors fire several per save) are folded into one trailing upload when the window
+    closes.
+    """
+    DEBOUNCE_SECONDS = 0.5
+
+    def __init__(self):
+        super().__init__()
+        self._windows = {}  # path -> True if it changed again inside its window
+        self._lock = threading.Lock()
+
+    def dispatch(self, event):
+        # One splitext + set lookup instead of fnmatch against each pattern.
         if event.is_directory:
             return
-        if event.src_path.endswith(('.txt', '.cpp', '.py', '.html')):
-            logger.info(f"Detected change on VM: {event.src_path}")
-            upload_to_s3(event.src_path)
+        if is_synced_name(event.src_path) or is_synced_name(getattr(event, "dest_path", "")):
+            super().dispatch(event)
+
+    def _schedule(self, path: str):
+        with self._lock:
+            if path in self._windows:
+                self._windows[path] = True
+                return
+            self._windows[path] = False
+
+        threading.Thread(target=upload_to_s3, args=(path,), daemon=True).start()
+        timer = threading.Timer(self.DEBOUNCE_SECONDS, self._close_window, args=(path,))
+        timer.daemon = True
+        timer.start()
+
+    def _close_window(self, path: str):
+        with self._lock:
+            dirty = self._windows.pop(path, False)
+        if dirty:
+            upload_to_s3(path)
+
+    def on_modified(self, event):
+        logger.info(f"Detected change on VM: {event.src_path}")
+        self._schedule(event.src_path)
 
     def on_created(self, event):
-        if event.is_directory:
-            return
-        if event.src_path.endswith(('.txt', '.cpp', '.py', '.html')):
-            logger.info(f"New file created on VM: {event.src_path}")
-            upload_to_s3(event.src_path)
+        logger.info(f"New file created on VM: {event.src_path}")
+        track_synced_file(event.src_path)
+        self._schedule(event.src_path)
+
+    def on_deleted(self, event):
+        track_synced_file(event.src_path, present=False)
+
+    def on_moved(self, event):
+        track_synced_file(event.src_path, present=False)
+        if is_synced_name(event.dest_path):
+            track_synced_file(event.dest_path)
+
+DRIVE_FIXED = 3
+SYNC_POLL_SEC = int(os.getenv("SYNC_POLL_SEC", "30"))
+
+def make_observer():
+    """
+    ReadDirectoryChangesW (event-driven, idle at zero CPU) when SYNCED_DIR is on a local
+    fixed drive. Network shares don't reliably deliver those notifications, so poll them,
+    but every SYNC_POLL_SEC seconds rather than watchdog's 1 s default.
+    """
+    drive = os.path.splitdrive(os.path.abspath(SYNCED_DIR))[0]
+    try:
+        drive_type = ctypes.windll.kernel32.GetDriveTypeW(drive + "\\") if drive else None
+    except (AttributeError, OSError):
+        drive_type = None
+    if drive_type == DRIVE_FIXED:
+        try:
+            from watchdog.observers.read_directory_changes import WindowsApiObserver
+            return WindowsApiObserver()
+        except ImportError:
+            return Observer()
+    if drive_type is None:
+        return Observer()
+    logger.info(f"{SYNCED_DIR} is not on a fixed drive; polling every {SYNC_POLL_SEC}s")
+    return PollingObserver(timeout=SYNC_POLL_SEC)
 
 def start_vm_file_watcher():
+    """Start the watcher on its own (daemon) observer thread and return the observer."""
     event_handler = NotepadSyncHandler()
-    observer = Observer()
-    observer.schedule(event_handler, SYNCED_DIR, recursive=True)
+    observer = make_observer()
+    observer.daemon = True
+    observer.schedule(event_handler, SYNCED_DIR, recursive=False)
     observer.start()
     logger.info(f"Watching for changes in VM files at: {SYNCED_DIR}")
-    try:
-        while True:
-            time.sleep(1)
-    except KeyboardInterrupt:
-        observer.stop()
+    return observer
+
+def stop_vm_file_watcher(observer):
+    observer.stop()
     observer.join()
 
 
+class S3MultipartWriter:
+    """
+    Write-only, non-seekable file object that ships its bytes to S3 as a multipart
+    upload: every `part_size` bytes become one UploadPart (a few in flight at once).
+    zipfile detects the missing seek() and writes data descriptors instead.
+    The upload is only created once the first part fills up; anything smaller is
+    sent with a single put_object on close().
+    """
+
+    def __init__(self, bucket: str, key: str, part_size: int = 16 * 1024 * 1024, max_in_flight: int = 4):
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, 5 * 1024 * 1024)  # S3 minimum for non-final parts
+        self._buf = bytearray()
+        self._pos = 0
+        self._parts = []
+        self._pending = []
+        self._pool = ThreadPoolExecutor(max_workers=max_in_flight)
+        self._max_in_flight = max_in_flight
+        self._upload_id = None
+
+    def write(self, data) -> int:
+        self._buf += data
+        self._pos += len(data)
+        while len(self._buf) >= self.part_size:
+            chunk = bytes(self._buf[:self.part_size])
+            del self._buf[:self.part_size]
+            self._submit(chunk)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._pos
+
+    def flush(self):
+        pass  # parts are only cut at part_size boundaries
+
+    def _submit(self, chunk: bytes):
+        if self._upload_id is None:
+            self._upload_id = s3.create_multipart_upload(Bucket=self.bucket, Key=self.key)["UploadId"]
+        if len(self._pending) >= self._max_in_flight:
+            self._parts.append(self._pending.pop(0).result())  # bound buffered memory
+        part_number = len(self._parts) + len(self._pending) + 1
+        self._pending.append(self._pool.submit(self._upload_part, part_number, chunk))
+
+    def _upload_part(self, part_number: int, chunk: bytes) -> dict:
+        resp = s3.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+            PartNumber=part_number, Body=chunk,
+        )
+        return {"PartNumber": part_number, "ETag": resp["ETag"]}
+
+    def close(self):
+        try:
+            if self._upload_id is None:
+                s3.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self._buf))
+                self._buf.clear()
+                return
+            if self._buf:
+                self._submit(bytes(self._buf))
+                self._buf.clear()
+            self._parts.extend(f.result() for f in self._pending)
+            self._pending.clear()
+            s3.complete_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                MultipartUpload={"Parts": self._parts},
+            )
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self._pool.shutdown(wait=False)
+
+    def abort(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        if self._upload_id is None:
+            return
+        try:
+            s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+        except Exception as e:
+            logger.warning(f"abort_multipart_upload failed for s3://{self.bucket}/{self.key}: {e}")
+
+
+_PRECOMPRESSED_EXTS = frozenset({
+    ".zip", ".gz", ".tgz", ".bz2", ".xz", ".zst", ".7z", ".rar", ".whl", ".jar",
+    ".png", ".jpg", ".jpeg", ".gif", ".webp", ".mp3", ".mp4", ".pdf", ".woff", ".woff2",
+})
+
+
+class IsalZipFile(zipfile.ZipFile):
+    """
+    Write-side ZipFile whose DEFLATE entries are compressed by ISA-L when it's installed.
+    Only the compressor of each new entry is swapped (same raw DEFLATE bitstream, so the
+    archive is unchanged for readers); zipfile's module-level zlib, and with it every
+    other zipfile user in the agent (e.g. /setup_vscode extraction), is left alone.
+    """
+
+    def _open_to_write(self, zinfo, force_zip64=False):
+        dest = super()._open_to_write(zinfo, force_zip64)
+        if isal_zlib is not None and zinfo.compress_type == zipfile.ZIP_DEFLATED:
+            level = getattr(zinfo, "compress_level", getattr(zinfo, "_compresslevel", None))
+            if level is None:
+                level = self.compresslevel if self.compresslevel is not None else 1
+            # ISA-L levels run 0-3; nothing has been fed to the stock compressor yet.
+            dest._compressor = isal_zlib.compressobj(min(max(level, 0), 3), isal_zlib.DEFLATED, -15)
+        return dest
+
+
+ZIP_SMALL_FILE_BYTES = 64 * 1024
+ZIP_MMAP_FILE_BYTES = 1024 * 1024
+
+def zip_write_entry(zf: zipfile.ZipFile, entry, arcname: str, compress_type: int,
+                    prefetched=None, copy_buf: bytearray | None = None):
+    """
+    Add one scanned file to zf. Throughput tradeoff vs plain zf.write (which re-stats the
+    path and feeds zlib through an 8 KiB read loop):
+      - small files: one read() + writestr, ZipInfo built from the DirEntry's stat
+        (`prefetched` is that (stat, bytes) pair when a reader thread already did it)
+      - large files: writestr over a read-only mmap (no userspace copy before zlib)
+      - everything in between: one readinto() the caller's reusable copy_buf
+        (ZIP_MMAP_FILE_BYTES long), so no per-file buffer allocation
+    """
+    st, data = prefetched or (entry.stat(follow_symlinks=False), None)
+
+    date_time = time.localtime(st.st_mtime)[:6]
+    zinfo = zipfile.ZipInfo(arcname, date_time=date_time if date_time[0] >= 1980 else (1980, 1, 1, 0, 0, 0))
+    zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
+    zinfo.compress_type = compress_type
+
+    if data is not None:
+        zf.writestr(zinfo, data, compresslevel=zf.compresslevel)
+        return
+    with open(entry.path, "rb", buffering=0) as f:
+        if st.st_size < ZIP_SMALL_FILE_BYTES:
+            zf.writestr(zinfo, f.read(), compresslevel=zf.compresslevel)
+        elif st.st_size < ZIP_MMAP_FILE_BYTES:
+            if copy_buf is None:
+                copy_buf = bytearray(ZIP_MMAP_FILE_BYTES)
+            with memoryview(copy_buf) as view:
+                n = 0
+                while n < st.st_size:
+                    got = f.readinto(view[n:])
+                    if not got:
+                        break
+                    n += got
+                zf.writestr(zinfo, view[:n], compresslevel=zf.compresslevel)
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                zf.writestr(zinfo, mm, compresslevel=zf.compresslevel)
+
+ZIP_READ_WORKERS = 8
+ZIP_READ_AHEAD = 64  # files read ahead of the compressor (small files only, so bounded memory)
+
+def _prefetch_small(entry):
+    """(stat, bytes) for a small file, or None to let the writer stream/mmap it."""
+    st = entry.stat(follow_symlinks=False)
+    if st.st_size >= ZIP_SMALL_FILE_BYTES:
+        return None
+    with open(entry.path, "rb") as f:
+        return st, f.read()
+
+def zip_dir_to_s3(folder_path: str, base: str, bucket: str, key: str, skip_dirs=PRUNED_DIR_NAMES):
+    """
+    Zip folder_path (entries under base/) directly into s3://bucket/key.
+    Reader threads open and read small files ahead of the single compressing writer, so
+    per-file open/read latency overlaps with DEFLATE instead of adding to it.
+    """
+    writer = S3MultipartWriter(bucket, key)
+    try:
+        # Level 1 DEFLATE: most of the ratio on source trees at a fraction of the CPU.
+        with IsalZipFile(writer, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=1) as zf, \
+                ThreadPoolExecutor(max_workers=ZIP_READ_WORKERS) as readers:
+            window = deque()
+            copy_buf = bytearray(ZIP_MMAP_FILE_BYTES)  # reused by the (single) writer thread
+
+            def write_oldest():
+                entry, future = window.popleft()
+                arcname = os.path.join(base, os.path.relpath(entry.path, folder_path))
+                # Already-compressed formats only burn CPU if deflated again.
+                ctype = zipfile.ZIP_STORED if os.path.splitext(entry.name)[1].lower() in _PRECOMPRESSED_EXTS else zipfile.ZIP_DEFLATED
+                zip_write_entry(zf, entry, arcname, ctype, future.result(), copy_buf)
+
+            for entry in iter_project_files(folder_path, skip_dirs):
+                window.append((entry, readers.submit(_prefetch_small, entry)))
+                if len(window) >= ZIP_READ_AHEAD:
+                    write_oldest()
+            while window:
+                write_oldest()
+    except Exception:
+        writer.abort()
+        raise
+    writer.close()
+
+
+# One path segment of ids (user ids are Supabase UUIDs): checked before any filesystem call.
+_NAME_RE = re.compile(r"^[A-Za-z0-9_.-]{1,128}$")
+
 @app.route("/export_project", methods=["POST"])
 def export_project():
-    auth = require_api_key()
-    if auth:
-        return auth
-
-    data = request.get_json(force=True) or {}
+    # silent: malformed bodies get the JSON 400 below instead of Flask's HTML error page
+    data = request.get_json(force=True, silent=True) or {}
     user_id = (data.get("user_id") or "").strip()
     project_name = (data.get("project_name") or "").strip()
 
     if not user_id or not project_name:
         return jsonify({"error": "user_id and project_name required"}), 400
 
+    if not _NAME_RE.match(user_id) or user_id in (".", ".."):
+        return jsonify({"error": "Invalid user_id"}), 400
+
     # ✅ sanitize project_name (avoid path traversal / slashes)
     project_name = os.path.basename(project_name.rstrip("\\/"))
-    if not project_name:
+    if not project_name or project_name in (".", ".."):
         return jsonify({"error": "Invalid project_name"}), 400
 
     # ✅ User-based VM layout
@@ -913,43 +1899,84 @@ def export_project():
     if not os.path.isdir(project_dir):
         return jsonify({"error": f"Project not found on VM: {project_dir}"}), 404
 
+    # Extra directory names to leave out, on top of the regenerable PRUNED_DIR_NAMES.
+    exclude_dirs = data.get("exclude_dirs") or []
+    if not isinstance(exclude_dirs, list) or not all(isinstance(d, str) for d in exclude_dirs):
+        return jsonify({"error": "exclude_dirs must be a list of directory names"}), 400
+    skip_dirs = PRUNED_DIR_NAMES | {d.strip("\\/") for d in exclude_dirs}
+
     stamp = str(int(time.time()))
     export_key = f"users/{user_id}/exports/{project_name}/{stamp}/project.zip"
 
-    exports_dir = r"C:\CloudRAM\VSCode\exports"
-    os.makedirs(exports_dir, exist_ok=True)
-    zip_path = os.path.join(exports_dir, f"{project_name}_{stamp}.zip")
-
-    # ✅ Zip INCLUDING top folder name exactly as project_name/
-    try:
-        with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
-            for root, dirs, files in os.walk(project_dir):
-                for f in files:
-                    full = os.path.join(root, f)
-                    rel_inside_project = os.path.relpath(full, project_dir)
-                    arcname = os.path.join(project_name, rel_inside_project)
-                    zf.write(full, arcname)
-    except Exception as e:
-        return jsonify({"error": f"Zip failed: {e}"}), 500
-
-    try:
-        s3.upload_file(zip_path, VSCODE_BUCKET_NAME, export_key)
-    except Exception as e:
-        return jsonify({"error": f"S3 upload failed: {e}"}), 500
-
-    return jsonify({
+    result = {
         "bucket": VSCODE_BUCKET_NAME,
         "export_key": export_key,
         "project_name": project_name,
         "vm_project_dir": project_dir
-    })
+    }
+
+    # Old synchronous contract for callers that still expect the object to exist on return.
+    if data.get("wait"):
+        try:
+            zip_dir_to_s3(project_dir, project_name, VSCODE_BUCKET_NAME, export_key, skip_dirs)
+        except Exception as e:
+            logger.error(f"Export of {project_dir} failed: {e}", exc_info=True)
+            return jsonify({"error": f"Zip/upload failed: {e}"}), 500
+        return jsonify(result)
+
+    job_id = str(uuid.uuid4())
+    prune_finished_jobs(export_jobs)
+    export_jobs[job_id] = {
+        **result,
+        "status": "running",
+        "message": "Zipping and uploading project...",
+        "started_at": datetime.utcnow().isoformat() + "Z",
+        "finished_at": None,
+    }
+
+    def worker():
+        # ✅ Zip INCLUDING top folder name exactly as project_name/
+        # Streamed straight into a multipart upload: no temp zip on disk.
+        try:
+            zip_dir_to_s3(project_dir, project_name, VSCODE_BUCKET_NAME, export_key, skip_dirs)
+            export_jobs[job_id]["status"] = "done"
+            export_jobs[job_id]["message"] = f"Exported to s3://{VSCODE_BUCKET_NAME}/{export_key}"
+        except Exception as e:
+            logger.error(f"[{job_id}] Export of {project_dir} failed: {e}", exc_info=True)
+            export_jobs[job_id]["status"] = "error"
+            export_jobs[job_id]["message"] = f"Zip/upload failed: {e}"
+        export_jobs[job_id]["finished_at"] = datetime.utcnow().isoformat() + "Z"
+
+    export_pool.submit(worker)
+
+    # Return immediately; poll /export_status/<job_id> until status is done or error.
+    return jsonify({"ok": True, "job_id": job_id, **result}), 202
+
+def job_status_response(job: dict):
+    """Job dict as JSON; running jobs also get a retry_after_ms poll hint."""
+    if job.get("status") != "running":
+        return jsonify(job)
+    # Poll hint: quick checks while a job is young, backing off to 5s as it runs long.
+    try:
+        started = datetime.fromisoformat(job["started_at"].rstrip("Z"))
+        elapsed = (datetime.utcnow() - started).total_seconds()
+    except Exception:
+        elapsed = 0
+    return jsonify({**job, "retry_after_ms": int(min(5000, max(250, elapsed * 100)))})
+
+@app.route("/export_status/<job_id>", methods=["GET"])
+def export_status(job_id):
+    job = export_jobs.get(job_id)
+    if not job:
+        return jsonify({"error": "job not found"}), 404
+    return job_status_response(job)
 
 @app.route("/vscode_setup_status/<job_id>", methods=["GET"])
 def vscode_setup_status(job_id):
     job = vscode_jobs.get(job_id)
     if not job:
         return jsonify({"error": "job not found"}), 404
-    return jsonify(job)
+    return job_status_response(job)
 
 def normalize_extracted_project_root(dest_project_dir: str) -> str:
     """
@@ -957,15 +1984,21 @@ def normalize_extracted_project_root(dest_project_dir: str) -> str:
     return that inner folder as the actual project root.
     """
     try:
-        items = [x for x in os.listdir(dest_project_dir) if x not in (".", "..")]
-        full_items = [os.path.join(dest_project_dir, x) for x in items]
-
-        dirs = [p for p in full_items if os.path.isdir(p)]
-        files = [p for p in full_items if os.path.isfile(p)]
+        only_dir = None
+        # scandir carries the entry type, so no stat per item; stop at the first entry
+        # that rules out a single wrapper folder.
+        with os.scandir(dest_project_dir) as it:
+            for entry in it:
+                if entry.is_dir():
+                    if only_dir is not None:
+                        return dest_project_dir
+                    only_dir = entry.path
+                elif entry.is_file():
+                    return dest_project_dir
 
         # If there's exactly one directory and no files at root, treat it as project root.
-        if len(dirs) == 1 and len(files) == 0:
-            return dirs[0]
+        if only_dir is not None:
+            return only_dir
     except Exception:
         pass
     return dest_project_dir
@@ -993,12 +2026,15 @@ def write_vscode_python_interpreter(project_root: str):
     settings = {}
     try:
         if os.path.exists(settings_path):
-            with open(settings_path, "r", encoding="utf-8") as f:
-                settings = json.load(f) or {}
+            with open(settings_path, "rb") as f:
+                raw = f.read()
+            settings = (orjson.loads(raw) if orjson is not None else json.loads(raw)) or {}
     except Exception as e:
         logger.warning(f"Could not read existing VSCode settings.json, overwriting. Reason: {e}")
         settings = {}
 
+    before = json.dumps(settings, sort_keys=True)
+
     # 1) Tell Python extension what interpreter to use
     settings["python.defaultInterpreterPath"] = venv_py
     settings["python.terminal.activateEnvironment"] = True
@@ -1010,22 +2046,50 @@ def write_vscode_python_interpreter(project_root: str):
     term_env["Path"] = f"{venv_scripts};${{env:Path}}"
     settings["terminal.integrated.env.windows"] = term_env
 
-    with open(settings_path, "w", encoding="utf-8") as f:
-        json.dump(settings, f, indent=2)
+    # Re-runs of /setup_vscode on the same project usually change nothing.
+    if json.dumps(settings, sort_keys=True) == before:
+        logger.info(f"VSCode venv settings already up to date: {settings_path}")
+        return
+
+    if orjson is not None:
+        data = orjson.dumps(settings, option=orjson.OPT_INDENT_2)
+    else:
+        data = json.dumps(settings, indent=2).encode("utf-8")
+    # Whole file in one write, swapped in atomically: VSCode never reads a half-written file.
+    tmp_path = settings_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, settings_path)
 
     logger.info(f"✅ VSCode venv forced in settings: {settings_path}")
 
 
+@app.before_request
 def require_api_key():
+    # Runs before every route, so no endpoint can forget the check.
     if not VM_API_KEY:
         return  # allow dev if not set
-    supplied = request.headers.get("X-VM-API-KEY")
-    if supplied != VM_API_KEY:
+    supplied = request.headers.get("X-VM-API-KEY", "").encode("utf-8")
+    # Constant-time: the comparison must not reveal how much of a guessed key matched.
+    if not hmac.compare_digest(supplied, _VM_API_KEY_BYTES):
         return jsonify({"error": "Unauthorized"}), 401
 
 if __name__ == "__main__":
     logger.info("Starting VM server...")
     ensure_dir("C:\\CloudRAM")
-    watcher_thread = threading.Thread(target=start_vm_file_watcher, daemon=True)
-    watcher_thread.start()
-    app.run(host="0.0.0.0", port=5000, debug=False, threaded=True)
+    load_sync_state()
+    observer = start_vm_file_watcher()
+    try:
+        try:
+            # Production WSGI server: a fixed pool of request threads, so UI polls such as
+            # /ram_usage keep answering while a VSCode setup is extracting and installing.
+            from waitress import serve
+        except ImportError:
+            logger.warning("waitress not installed; falling back to the Flask development server")
+            app.run(host="0.0.0.0", port=5000, debug=False, threaded=True)
+        else:
+            serve(app, host="0.0.0.0", port=5000, threads=16, channel_timeout=300)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_vm_file_watcher(observer)
@@ -151,7 +151,7 @@ switch ($currentState) {
         try {
             Start-Process -FilePath "choco" -ArgumentList "install python python-pip -y" -Wait -NoNewWindow -PassThru | Out-Null
             $env:Path = [System.Environment]::GetEnvironmentVariable("Path", "Machine") + ";" + [System.Environment]::GetEnvironmentVariable("Path", "User")
-            Start-Process -FilePath "cmd.exe" -ArgumentList "/c pip install websockify flask flask-cors psutil boto3 watchdog" -Wait -NoNewWindow -PassThru | Out-Null
+            Start-Process -FilePath "cmd.exe" -ArgumentList "/c pip install websockify flask flask-cors psutil boto3 watchdog waitress orjson isal" -Wait -NoNewWindow -PassThru | Out-Null
         } catch {
             Write-EC2Log "ERROR: Failed to install Python or packages - $($_.Exception.Message)"
             exit 1